@@ -0,0 +1,90 @@
+import os
+import sys
+import re
+import time
+import tempfile
+import tracemalloc
+from datetime import datetime, timedelta
+from contextlib import redirect_stdout
+from io import StringIO
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from reconciliation.common import parse_event_file, parse_event_file_ms
+
+def parse_event_file_regex(file_path):
+    """The former whole-file regex parser, kept as the baseline for comparison"""
+    events = []
+    with open(file_path, 'r') as f:
+        content = f.read()
+
+    start_time_match = re.search(r'Start Time:\s*(.*)', content)
+    if start_time_match:
+        start_time = datetime.strptime(start_time_match.group(1).strip(), "%m/%d/%Y %I:%M:%S %p")
+    else:
+        raise ValueError("Start Time not found in the file.")
+
+    event_pattern = r'(\d{2}:\d{2}:\d{2},\d{3}-\d{2}:\d{2}:\d{2},\d{3});\s*(\d+);\s*(.*?)(?=(\d{2}:\d{2}:\d{2},\d{3}-|$))'
+    for match in re.finditer(event_pattern, content, re.DOTALL):
+        start_str, end_str = match.group(1).split('-')
+        event_type = match.group(3).strip()
+        start = datetime.strptime(start_str.strip(), '%H:%M:%S,%f')
+        end = datetime.strptime(end_str.strip(), '%H:%M:%S,%f')
+        start = start.replace(year=start_time.year, month=start_time.month, day=start_time.day)
+        end = end.replace(year=start_time.year, month=start_time.month, day=start_time.day)
+        if start.time() < start_time.time():
+            start += timedelta(days=1)
+        if end.time() < start_time.time() or end < start:
+            end += timedelta(days=1)
+        events.append((start, end, event_type))
+
+    return events, start_time
+
+def write_event_file(file_path, n_events, concatenated_every=10):
+    """Write a synthetic export starting at 10 PM, crossing midnight, with some concatenated events"""
+    start_time = datetime(2024, 1, 15, 22, 0, 0)
+    current = start_time
+    with open(file_path, 'w') as f:
+        f.write("Signal ID: FlowEvents\n")
+        f.write(f"Start Time: {start_time.strftime('%m/%d/%Y %I:%M:%S %p')}\n")
+        f.write("Unit: s\nSignal Type: Impuls\n\n")
+        for i in range(n_events):
+            current += timedelta(milliseconds=2500 + (i * 7919) % 60000)
+            end = current + timedelta(milliseconds=10000 + (i * 104729) % 20000)
+            record = f"{current.strftime('%H:%M:%S,%f')[:-3]}-{end.strftime('%H:%M:%S,%f')[:-3]}; {int((end - current).total_seconds())};Obstructive Apnea"
+            f.write(record if i % concatenated_every == 0 else record + "\n")
+
+def benchmark(parser, file_path, repeats):
+    best = float('inf')
+    for _ in range(repeats):
+        with redirect_stdout(StringIO()):
+            begin = time.perf_counter()
+            events, _ = parser(file_path)
+            best = min(best, time.perf_counter() - begin)
+
+    tracemalloc.start()
+    with redirect_stdout(StringIO()):
+        parser(file_path)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return best, peak, len(events)
+
+if __name__ == "__main__":
+    repeats = 3
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for n_events in [1000, 10000, 100000]:
+            file_path = os.path.join(tmp_dir, f"events_{n_events}.txt")
+            write_event_file(file_path, n_events)
+            size_mb = os.path.getsize(file_path) / 1e6
+
+            results = {name: benchmark(parser, file_path, repeats)
+                       for name, parser in [('regex', parse_event_file_regex), ('streaming', parse_event_file),
+                                            ('ms', parse_event_file_ms)]}
+            with redirect_stdout(StringIO()):
+                if parse_event_file_regex(file_path) != parse_event_file(file_path):
+                    raise AssertionError("Streaming parser output differs from the regex parser")
+
+            print(f"\n{n_events} events ({size_mb:.1f} MB)")
+            for name, (seconds, peak, count) in results.items():
+                print(f"  {name:>9}: {seconds * 1000:8.1f} ms, {count / seconds:10.0f} events/s, "
+                      f"{size_mb / seconds:6.1f} MB/s, parse peak {peak / 1e6:.1f} MB")
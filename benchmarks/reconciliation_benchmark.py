@@ -0,0 +1,108 @@
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import tempfile
+from collections import Counter
+from datetime import datetime
+from itertools import product
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from reconciliation import arousal, flow, staging
+from synthetic_data import generate_data
+from utils.phases import start_phases, stop_phases
+
+PHASES = ['parse', 'bin', 'group', 'resolve', 'write']
+
+def add_phase_times(phases, study_phases):
+    for phase, values in study_phases.items():
+        phases[phase] += values['wall_seconds']
+
+def run_event_pipeline(module, engine, study_paths, output_dir):
+    counters = Counter()
+    phases = Counter()
+    for study_path in study_paths:
+        start_phases()
+        output_csv, error = module.process_study(study_path, output_dir, engine, counters)
+        add_phase_times(phases, stop_phases())
+        if error:
+            raise RuntimeError(error)
+    return phases, counters
+
+def run_staging_pipeline(study_paths, output_dir):
+    counters = Counter()
+    phases = Counter()
+    for study_path in study_paths:
+        start_phases()
+        file_path = os.path.join(study_path, f"{os.path.basename(study_path)}.csv")
+        disagreement_count, partial_agreement_count, total_epochs = staging.analyze_agreement_and_generate_simplified_annotations(
+            file_path, output_dir)
+        add_phase_times(phases, stop_phases())
+        counters['epochs'] += total_epochs
+        counters['epochs_disagreement'] += disagreement_count
+    return phases, counters
+
+def benchmark(pipeline, engine, study_paths, output_dir, repeats):
+    """Run a pipeline over the studies repeats times and keep the fastest run"""
+    best = None
+    for _ in range(repeats):
+        begin = time.perf_counter()
+        if pipeline == 'staging':
+            phases, counters = run_staging_pipeline(study_paths, output_dir)
+        else:
+            module = flow if pipeline == 'flow' else arousal
+            phases, counters = run_event_pipeline(module, engine, study_paths, output_dir)
+        seconds = time.perf_counter() - begin
+        if best is None or seconds < best['seconds']:
+            best = {'seconds': seconds, 'phases': {phase: phases.get(phase, 0.0) for phase in PHASES}, 'counters': dict(counters)}
+    return best
+
+def run_grid(night_hours_grid, events_per_hour_grid, engines, n_studies, repeats, jitter_seconds, disagreement_rate, start_hour):
+    results = []
+    for night_hours, events_per_hour in product(night_hours_grid, events_per_hour_grid):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            data_path = os.path.join(tmp_dir, 'data_all')
+            study_paths = generate_data(data_path, n_studies, night_hours=night_hours, events_per_hour=events_per_hour,
+                                        jitter_seconds=jitter_seconds, disagreement_rate=disagreement_rate, start_hour=start_hour)
+            for pipeline, engine in engines:
+                output_dir = os.path.join(tmp_dir, 'output', f"{pipeline}_{engine}")
+                os.makedirs(output_dir, exist_ok=True)
+                result = benchmark(pipeline, engine, study_paths, output_dir, repeats)
+                result.update({'pipeline': pipeline, 'engine': engine, 'night_hours': night_hours,
+                               'events_per_hour': events_per_hour, 'studies': n_studies})
+                results.append(result)
+                phases = ", ".join(f"{phase} {seconds:.3f}" for phase, seconds in result['phases'].items())
+                print(f"{pipeline:>8} {engine:>8} {night_hours:5.1f} h {events_per_hour:6.0f}/h: {result['seconds']:8.3f} s ({phases})")
+    return results
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Time the reconciliation pipelines on synthetic studies")
+    parser.add_argument('--output', default='reconciliation_benchmark.json', help="JSON file for the results")
+    parser.add_argument('--night-hours', type=float, nargs='+', default=[4, 8, 12])
+    parser.add_argument('--events-per-hour', type=float, nargs='+', default=[20, 60, 180])
+    parser.add_argument('--studies', type=int, default=2, help="Studies per grid point")
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--jitter-seconds', type=float, default=3)
+    parser.add_argument('--disagreement-rate', type=float, default=0.2)
+    parser.add_argument('--start-hour', type=float, default=22.5)
+    parser.add_argument('--engines', nargs='+', default=['flow:bins', 'flow:sweep', 'arousal:bins', 'arousal:bitmask', 'staging:pandas'],
+                        help="pipeline:engine pairs to run")
+    args = parser.parse_args()
+
+    engines = [tuple(pair.split(':')) for pair in args.engines]
+    results = run_grid(args.night_hours, args.events_per_hour, engines, args.studies, args.repeats,
+                       args.jitter_seconds, args.disagreement_rate, args.start_hour)
+
+    report = {
+        'created': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'parameters': {key: value for key, value in vars(args).items() if key != 'output'},
+        'results': results,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"Results written to {args.output}")
@@ -0,0 +1,117 @@
+import os
+import random
+import argparse
+from datetime import datetime, timedelta
+
+SCORERS = ['LS', 'ES', 'MS']
+FLOW_TYPES = ['Obstructive Apnea', 'Hypopnea', 'Central Apnea', 'Mixed Apnea']
+STAGES = ['W', 'N1', 'N2', 'N3', 'REM']
+EPOCH_SECONDS = 30
+
+def format_clock(dt):
+    return dt.strftime('%H:%M:%S,') + f"{dt.microsecond // 1000:03d}"
+
+def write_event_file(file_path, signal_id, start_time, events, concatenated_rate, rng):
+    """Write events in the scorer export format, joining some records onto one line as real exports do"""
+    with open(file_path, 'w') as f:
+        f.write(f"Signal ID: {signal_id}\n")
+        f.write(f"Start Time: {start_time.strftime('%m/%d/%Y %I:%M:%S %p')}\n")
+        f.write("Unit: s\nSignal Type: Impuls\n\n")
+        for start, end, event_type in events:
+            record = f"{format_clock(start)}-{format_clock(end)}; {int((end - start).total_seconds())};{event_type}"
+            f.write(record if rng.random() < concatenated_rate else record + "\n")
+        f.write("\n")
+
+def base_events(start_time, night_hours, events_per_hour, min_seconds, max_seconds, event_types, rng):
+    """Events of the underlying 'true' scoring, spread uniformly over the night"""
+    night_ms = int(night_hours * 3600 * 1000)
+    n_events = int(night_hours * events_per_hour)
+    events = []
+    for offset in sorted(rng.randrange(night_ms) for _ in range(n_events)):
+        start = start_time + timedelta(milliseconds=offset)
+        duration = timedelta(milliseconds=rng.randint(min_seconds * 1000, max_seconds * 1000))
+        events.append((start, start + duration, rng.choice(event_types)))
+    return events
+
+def scorer_events(events, jitter_seconds, disagreement_rate, event_types, rng):
+    """One scorer's version of the base events: jittered boundaries, and with probability
+    disagreement_rate a missed event, a different event type or an extra event"""
+    jitter_ms = int(jitter_seconds * 1000)
+    scored = []
+    for start, end, event_type in events:
+        start += timedelta(milliseconds=rng.randint(-jitter_ms, jitter_ms))
+        end += timedelta(milliseconds=rng.randint(-jitter_ms, jitter_ms))
+        if end <= start:
+            end = start + timedelta(seconds=1)
+        if rng.random() < disagreement_rate:
+            outcome = rng.choice(['missed', 'type', 'extra'])
+            if outcome == 'missed':
+                continue
+            if outcome == 'type':
+                event_type = rng.choice(event_types)
+            else:
+                shift = timedelta(seconds=rng.randint(30, 120))
+                scored.append((start + shift, end + shift, rng.choice(event_types)))
+        scored.append((start, end, event_type))
+    return sorted(scored)
+
+def write_staging_file(file_path, night_hours, disagreement_rate, rng):
+    """Write a scorer CSV with one stage per epoch and column per scorer"""
+    n_epochs = int(night_hours * 3600 // EPOCH_SECONDS)
+    stage = 'W'
+    with open(file_path, 'w') as f:
+        f.write("Epoch;Scorer ES;Scorer MS;Scorer LS\n")
+        for epoch in range(n_epochs):
+            # Stages last several epochs before changing
+            if rng.random() < 0.1:
+                stage = rng.choice(STAGES)
+            scores = [rng.choice(STAGES) if rng.random() < disagreement_rate else stage for _ in SCORERS]
+            f.write(f"{epoch + 1};{';'.join(scores)}\n")
+
+def generate_study(data_path, study, night_hours=8, events_per_hour=30, jitter_seconds=3, disagreement_rate=0.2,
+                   start_hour=22.5, concatenated_rate=0.05, seed=0):
+    """Generate data_path/<study>/{LS,ES,MS} with flow events, arousals and markers, plus the staging CSV.
+
+    start_hour sets the lights-off time; nights that run past 24:00 cross midnight.
+    """
+    rng = random.Random(seed)
+    start_time = datetime(2024, 1, 15) + timedelta(seconds=int(start_hour * 3600) + rng.randrange(600))
+    study_path = os.path.join(data_path, study)
+
+    flow_events = base_events(start_time, night_hours, events_per_hour, 10, 40, FLOW_TYPES, rng)
+    arousal_events = base_events(start_time, night_hours, events_per_hour, 3, 15, ['Arousal'], rng)
+
+    for scorer in SCORERS:
+        scorer_path = os.path.join(study_path, scorer)
+        os.makedirs(scorer_path, exist_ok=True)
+        write_event_file(os.path.join(scorer_path, 'Flow Events.txt'), 'FlowEvents', start_time,
+                         scorer_events(flow_events, jitter_seconds, disagreement_rate, FLOW_TYPES, rng), concatenated_rate, rng)
+        write_event_file(os.path.join(scorer_path, 'Classification Arousals.txt'), 'ClassificationArousals', start_time,
+                         scorer_events(arousal_events, jitter_seconds, disagreement_rate, ['Arousal'], rng), concatenated_rate, rng)
+
+    with open(os.path.join(study_path, 'ES', 'Markers.txt'), 'w') as f:
+        f.write("Signal ID: Markers\n\n")
+        f.write(f"{format_clock(start_time)}; 1; Start\n")
+
+    write_staging_file(os.path.join(study_path, f"{study}.csv"), night_hours, disagreement_rate, rng)
+    return study_path
+
+def generate_data(data_path, n_studies, seed=0, **params):
+    """Generate n_studies studies named SYN000, SYN001, ... and return their paths"""
+    return [generate_study(data_path, f"SYN{index:03d}", seed=seed * 1000 + index, **params) for index in range(n_studies)]
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate synthetic scorer data in the data_all layout")
+    parser.add_argument('data_path')
+    parser.add_argument('--studies', type=int, default=5)
+    parser.add_argument('--night-hours', type=float, default=8)
+    parser.add_argument('--events-per-hour', type=float, default=30)
+    parser.add_argument('--jitter-seconds', type=float, default=3)
+    parser.add_argument('--disagreement-rate', type=float, default=0.2)
+    parser.add_argument('--start-hour', type=float, default=22.5, help="Lights off; e.g. 0.5 for nights that do not cross midnight")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    paths = generate_data(args.data_path, args.studies, args.seed, night_hours=args.night_hours,
+                          events_per_hour=args.events_per_hour, jitter_seconds=args.jitter_seconds,
+                          disagreement_rate=args.disagreement_rate, start_hour=args.start_hour)
+    print(f"Generated {len(paths)} studies in {args.data_path}")
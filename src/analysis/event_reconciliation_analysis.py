@@ -1,8 +1,13 @@
 import pandas as pd
-import glob
 import os
-import seaborn as sns
-import matplotlib.pyplot as plt
+import sys
+
+if __package__ in (None, ''):
+    # Running as a script: make the src directory importable
+    sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.discovery import build_output_index, subjects_with
+from utils.stage_runs import expand_stage_rows
 
 def analyze_staging_reconciliation(subject_id):
     """Analyze staging reconciliation for a given subject"""
@@ -12,7 +17,8 @@ def analyze_staging_reconciliation(subject_id):
         print(f"File not found: {stage_file}")  
         return None
     
-    df = pd.read_csv(stage_file, delimiter='\t')
+    # Staging can write runs of the same stage as one row; count each epoch
+    df = expand_stage_rows(pd.read_csv(stage_file, delimiter='\t'))
     
     # Count total epochs and epochs needing review
     total_epochs = len(df)
@@ -39,25 +45,29 @@ def analyze_staging_reconciliation(subject_id):
     return results
 
 def analyze_reconciliation_files():
+    # Plotting libraries are only needed here, so importing this module stays cheap
+    import seaborn as sns
+    import matplotlib.pyplot as plt
+
     # Load demographics data
     demographics_df = pd.read_csv('../../output/demographics.csv')
     
-    # Analyze both event and staging reconciliation
-    directories = {
-        'Flow': '../../output/flow_reconciliation_output/*.csv',
-        'Arousal': '../../output/arousal_reconciliation_output/*.csv',
-        'Staging': '../../output/staging_annotation/*_stage_annotations.csv'
+    # Analyze both event and staging reconciliation, finding every subject's files in one listing
+    index = build_output_index('../../output')
+    artifacts = {
+        'Flow': 'flow',
+        'Arousal': 'arousal',
+        'Staging': 'staging'
     }
     
-    for data_type, path_pattern in directories.items():
-        csv_files = glob.glob(path_pattern)
+    for data_type, kind in artifacts.items():
         demographic_data = []
         
         print(f"\n{data_type.upper()} RECONCILIATION ANALYSIS")
         print("=" * 30)
         
-        for file in csv_files:
-            subject_id = os.path.basename(file).split('_')[0]
+        for subject_id in subjects_with(index, kind):
+            file = index[subject_id][kind]
             
             if data_type == 'Staging':
                 results = analyze_staging_reconciliation(subject_id)
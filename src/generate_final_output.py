@@ -1,36 +1,80 @@
 import os
-from utils.combine_events import process_all_files as combine_events
-from utils.merge_staging_events import main as merge_staging_events
-from utils.add_stage_numbers import add_stage_numbers
-
-def run_stage_numbering():
-    input_dir = "output/staging_annotation"
-    
-    # Process all CSV files in the directory
-    for filename in os.listdir(input_dir):
-        if filename.endswith("_stage_annotations.csv"):
-            input_file = os.path.join(input_dir, filename)
-            
-            # Create output filename by inserting "_numbered" before ".csv"
-            base_name = filename[:-4]  # remove .csv
-            output_filename = f"{base_name}_numbered.csv"
-            output_file = os.path.join(input_dir, output_filename)
-            
-            add_stage_numbers(input_file, output_file)
-            print(f"Created numbered annotations file: {output_file}")
-
-def generate_final_output():
-    # Step 1: Run stage numbering
-    print("Running stage numbering...")
-    run_stage_numbering()
-    
-    # Step 2: Combine events
-    print("Combining events...")
-    combine_events()
-    
-    # Step 3: Merge staging and events
-    print("Merging staging and events...")
-    merge_staging_events()
+from utils.combine_events import combined_events, write_combined_csv
+from utils.merge_staging_events import events_frame, write_merged_file
+from utils.add_stage_numbers import read_numbered_stages
+from utils.discovery import build_output_index
+from utils.phases import enable_phase_report, end_phase
+from utils.pipeline import run_pipeline
+
+BASE_DIR = 'output'
+DATA_DIR = 'data_all'
+# What each final output was built from is recorded in output/final_output.manifest.json
+MANIFEST_DIR = os.path.join(BASE_DIR, 'final_output')
+
+def staging_file(subject_id):
+    return os.path.join(BASE_DIR, 'staging_annotation', f'{subject_id}_stage_annotations.csv')
+
+def numbered_file(subject_id):
+    return os.path.join(BASE_DIR, 'staging_annotation', f'{subject_id}_stage_annotations_numbered.csv')
+
+def combined_file(subject_id):
+    return os.path.join(BASE_DIR, 'combined', f'{subject_id}_combined_events.csv')
+
+def merged_file(subject_id):
+    return os.path.join(BASE_DIR, 'merged', f'{subject_id}_merged.csv')
+
+def event_files(subject_id):
+    paths = [os.path.join(BASE_DIR, 'flow_reconciliation_output', f'{subject_id}_flow_reconciliation.csv'),
+             os.path.join(BASE_DIR, 'arousal_reconciliation_output', f'{subject_id}_arousal_reconciliation_no_label.csv')]
+    return [path for path in paths if os.path.exists(path)]
+
+def merge_inputs(subject_id):
+    if not event_files(subject_id):
+        return None
+    if not os.path.exists(staging_file(subject_id)):
+        print(f"No staging file found for {subject_id}")
+        return None
+    # The start time comes from the ES markers, or the MS markers if ES has none
+    markers = [os.path.join(DATA_DIR, subject_id, scorer, 'Markers.txt') for scorer in ['ES', 'MS']]
+    return [staging_file(subject_id)] + event_files(subject_id) + markers
+
+def build_merged(subject_id, input_paths, output_file, keep_intermediate_files=False):
+    """Number the stages, combine the events and merge them for one subject, passing the
+    tables along in memory. keep_intermediate_files also writes the numbered staging and
+    combined events files the separate steps in utils/ produce, for debugging."""
+    # input_paths is the staging file, the event files and the markers, as listed by merge_inputs
+    staging_path, event_paths = input_paths[0], input_paths[1:-2]
+    staging_df = read_numbered_stages(staging_path)
+    if keep_intermediate_files:
+        staging_df.to_csv(numbered_file(subject_id), sep='\t', index=False)
+    end_phase('stage_numbering')
+
+    events = combined_events(event_paths)
+    if keep_intermediate_files:
+        os.makedirs(os.path.dirname(combined_file(subject_id)), exist_ok=True)
+        write_combined_csv(events, combined_file(subject_id))
+    end_phase('combine')
+
+    print(f"Processing {subject_id}...")
+    write_merged_file(subject_id, events_frame(events), staging_df, output_file)
+
+def generate_final_output(jobs=1, incremental=True, keep_intermediate_files=False):
+    """Write the merged annotation file of every subject in output/.
+
+    With incremental, merged files whose inputs are unchanged since they were built
+    are kept, so after re-running one study only that study's file is rebuilt.
+    """
+    index = build_output_index(BASE_DIR)
+    subject_ids = [subject_id for subject_id, artifacts in index.items()
+                   if any(kind in artifacts for kind in ('staging', 'flow', 'arousal'))]
+    steps = [{'name': 'merge', 'inputs': merge_inputs, 'output': merged_file, 'run': build_merged,
+              'params': {'keep_intermediate_files': keep_intermediate_files}}]
+    return run_pipeline(steps, subject_ids, MANIFEST_DIR, jobs, incremental)
 
 if __name__ == "__main__":
-    generate_final_output() 
\ No newline at end of file
+    phase_report = None  # Set to a .jsonl path to record time and memory per step
+    jobs = 1  # Number of subjects to build in parallel
+    incremental = True  # Set to False to rebuild every file
+    keep_intermediate_files = False  # Set to True to also write the numbered staging and combined events files
+    enable_phase_report(phase_report)
+    generate_final_output(jobs, incremental, keep_intermediate_files)
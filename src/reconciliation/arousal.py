@@ -1,52 +1,29 @@
 import os
-from datetime import datetime, timedelta
-import csv
-import re
+import sys
+import logging
+from collections import Counter
+from datetime import timedelta
+import numpy as np
 
-def parse_event_file(file_path):
-    events = []
-    start_time = None
-    with open(file_path, 'r') as f:
-        content = f.read()
-
-    # Extract the Start Time
-    start_time_match = re.search(r'Start Time:\s*(.*)', content)
-    
-    if start_time_match:
-        start_time_str = start_time_match.group(1).strip()
-        start_time = datetime.strptime(start_time_str, "%m/%d/%Y %I:%M:%S %p")
-    else:
-        raise ValueError("Start Time not found in the file.")
-
-    # Handle concatenated events
-    event_pattern = r'(\d{2}:\d{2}:\d{2},\d{3}-\d{2}:\d{2}:\d{2},\d{3});\s*(\d+);\s*(.*?)(?=(\d{2}:\d{2}:\d{2},\d{3}-|$))'
-    matches = re.finditer(event_pattern, content, re.DOTALL)
-
-    for match in matches:
-        time_range = match.group(1)
-        duration = match.group(2)
-        event_type = match.group(3).strip()
-
-        start_str, end_str = time_range.split('-')
+if __package__ in (None, ''):
+    # Running as a script: make the src directory importable
+    sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
-        # Parse start and end times
-        start = datetime.strptime(start_str.strip(), '%H:%M:%S,%f')
-        end = datetime.strptime(end_str.strip(), '%H:%M:%S,%f')
+from reconciliation.common import build_boundary_index, process_event_studies, process_event_study, read_scorer_files, second_of_ms
+from utils.batch import append_error_log
+from utils.phases import end_phase
+from utils.progress import configure_logging, flush_event_details, get_event_logger, get_logger
+from utils.timecodes import MS_PER_DAY, datetime_to_offset, offset_to_datetime
 
-        # Adjust date components
-        start = start.replace(year=start_time.year, month=start_time.month, day=start_time.day)
-        end = end.replace(year=start_time.year, month=start_time.month, day=start_time.day)
+SCORERS = ['LS', 'ES', 'MS']
+# Periods scored by a single scorer are only flagged for review when longer than this
+SINGLE_SCORER_MIN_SECONDS = 10
 
-        # Handle events that cross midnight
-        if start.time() < start_time.time():
-            start += timedelta(days=1)
-        if end.time() < start_time.time() or end < start:
-            end += timedelta(days=1)
+logger = get_logger('arousal')
+event_logger = get_event_logger()
 
-        events.append((start, end, event_type))
-
-    print(f"\nTotal events processed: {len(events)}")
-    return events, start_time
+# Number of set bits for every LS/ES/MS occupancy mask
+POPCOUNT = np.array([bin(mask).count('1') for mask in range(1 << len(SCORERS))], dtype=np.uint8)
 
 def create_bins(events, bin_size=timedelta(seconds=1)):
     bins = set()
@@ -57,32 +34,37 @@ def create_bins(events, bin_size=timedelta(seconds=1)):
             current += bin_size
     return bins
 
-def reconcile_study(study_path, output_dir):
+def reconcile_study(study_path, output_dir, engine='bins', scorer_files=None, counters=None):
+    """Reconcile a study's scorers. scorer_files can pass in already parsed files, as returned
+    by read_scorer_files, instead of reading them from study_path. Event counts are added to counters."""
+    if counters is None:
+        counters = Counter()
     error_log = os.path.join(output_dir, "error_log.txt")
-    scorers = ['LS', 'ES', 'MS']
+    scorers = SCORERS
     all_events = {}
+    file_start_times = {}
     study_start_time = None
 
-    print(f"Processing study: {study_path}")
+    logger.debug("Processing study: %s", study_path)
 
     # Parse events from each scorer
+    if scorer_files is None:
+        scorer_files = read_scorer_files(study_path, 'Classification Arousals.txt', scorers)
     event_counts = []  # Track number of events per scorer
     for scorer in scorers:
-        file_path = os.path.join(study_path, scorer, 'Classification Arousals.txt')
-        if not os.path.exists(file_path):
-            print(f"File not found for scorer {scorer}: {file_path}")
+        if scorer not in scorer_files:
             event_counts.append(0)
             continue
-        events, start_time = parse_event_file(file_path)
+        events, start_time = scorer_files[scorer]
         event_counts.append(len(events))
         if len(events) == 0:
-            with open(error_log, 'a') as f:
-                f.write(f"{datetime.now()}: WARNING - No events found for scorer {scorer} in study {study_path}\n")
+            append_error_log(error_log, f"WARNING - No events found for scorer {scorer} in study {study_path}")
             continue
         all_events[scorer] = events
+        file_start_times[scorer] = start_time
         if study_start_time is None or start_time < study_start_time:
             study_start_time = start_time
-        print(f"Parsed {len(events)} events for scorer {scorer}")
+        logger.debug("Parsed %d events for scorer %s", len(events), scorer)
 
     # Check if we have any events at all
     if not all_events:
@@ -91,6 +73,12 @@ def reconcile_study(study_path, output_dir):
     if sum(event_counts) == 0:
         raise ValueError(f"No events found in any scorer files. Event counts: {dict(zip(scorers, event_counts))}")
 
+    # Express all events in milliseconds since the study start
+    for scorer, events in all_events.items():
+        offset = datetime_to_offset(study_start_time, file_start_times[scorer])
+        if offset:
+            all_events[scorer] = [(start + offset, end + offset, event_type) for start, end, event_type in events]
+
     # Get all bins where any scorer has an event - with error handling
     try:
         last_event_end = max(max(event[1] for event in events) for events in all_events.values())
@@ -98,10 +86,33 @@ def reconcile_study(study_path, output_dir):
         raise ValueError("No events found in any of the parsed files")
 
     # If study start time and last event are more than 2 days apart, raise an error
-    if (last_event_end - study_start_time).days > 2:
-        raise ValueError(f"Study start time and last event are more than 2 days apart: {study_start_time} to {last_event_end}")
+    if last_event_end // MS_PER_DAY > 2:
+        raise ValueError(f"Study start time and last event are more than 2 days apart: {study_start_time} to {offset_to_datetime(study_start_time, last_event_end)}")
+
+    logger.debug("Study start time: %s", study_start_time)
+
+    end_phase('parse')
+    final_events = ENGINES[engine](all_events, study_start_time, last_event_end, counters)
+    flush_event_details()
 
-    print(f"Study start time: {study_start_time}")
+    counters['events_parsed'] += sum(event_counts)
+    counters['events_reconciled'] += len(final_events)
+    counters['events_flagged'] += sum(1 for _, _, description in final_events if description.startswith('Review'))
+    logger.debug("Final number of events: %d", len(final_events))
+    return final_events, study_start_time
+
+def reconcile_with_bins(all_events, study_start_time, last_event_end, counters=None):
+    """Reconcile parsed events using one-second bins from study start to the last event end"""
+    if counters is None:
+        counters = Counter()
+    log_events = event_logger.isEnabledFor(logging.DEBUG)
+    scorers = SCORERS
+    # This engine works on datetimes; convert from and back to milliseconds since study start
+    all_events = {scorer: [(offset_to_datetime(study_start_time, start), offset_to_datetime(study_start_time, end), event_type)
+                           for start, end, event_type in events]
+                  for scorer, events in all_events.items()}
+    last_event_end = offset_to_datetime(study_start_time, last_event_end)
+    exact_starts, exact_ends = build_boundary_index(all_events)
 
     # Get all bins where any scorer has an event
     all_bins = []
@@ -110,7 +121,7 @@ def reconcile_study(study_path, output_dir):
         all_bins.append(current_time)
         current_time += timedelta(seconds=1)
     
-    print(f"Created {len(all_bins)} bins from {study_start_time} to {last_event_end}")
+    logger.debug("Created %d bins from %s to %s", len(all_bins), study_start_time, last_event_end)
 
     # Create a mapping from bin_time to scores
     bin_scores = {}
@@ -124,6 +135,7 @@ def reconcile_study(study_path, output_dir):
                 if bin_time in bin_scores:
                     bin_scores[bin_time][scorer] = 1
                 current += timedelta(seconds=1)
+    end_phase('bin')
 
     # Group bins into contiguous events
     events = []
@@ -138,7 +150,7 @@ def reconcile_study(study_path, output_dir):
                 current_event_bins = []
     if current_event_bins:
         events.append(current_event_bins)
-
+    end_phase('group')
 
     final_events = []
    
@@ -154,25 +166,18 @@ def reconcile_study(study_path, output_dir):
             if sum(scores.values()) >= 2:
                 if start_two_techs is None:
                     start_two_techs = bin_time
-                    # Find the earliest exact start time from original events
-                    exact_start = min(event[0] for scorer, events in all_events.items() 
-                                      for event in events if event[0].replace(microsecond=0) == bin_time)
                 end_two_techs = bin_time
         
         if start_two_techs and end_two_techs:
             # Find the exact start and end times
-            exact_start = min((event[0] for scorer, events in all_events.items() 
-                               for event in events if event[0].replace(microsecond=0) == start_two_techs),
-                              key=time_only,
-                              default=start_two_techs)
+            exact_start = exact_starts.get(start_two_techs, start_two_techs)
             
-            end_events = [event[1] for scorer, events in all_events.items() 
-                          for event in events if event[1].replace(microsecond=0) == end_two_techs]
-            
-            exact_end = max(end_events, key=time_only, default=end_two_techs)
+            exact_end = exact_ends.get(end_two_techs, end_two_techs)
             
             if exact_end == end_two_techs:
-                print(f"Info: No exact end time found for event {event_index}. Using bin time: {exact_end}")
+                counters['boundary_misses'] += 1
+                if log_events:
+                    event_logger.debug("No exact end time found for event %d. Using bin time: %s", event_index, exact_end)
             
             # Add the event scored by at least two techs
             final_events.append([exact_start, exact_end, "Arousal"])
@@ -187,10 +192,7 @@ def reconcile_study(study_path, output_dir):
                         if not one_tech_period_before:
                             # Find the exact start time for this period
                             scorer = next(scorer for scorer, score in bin_scores_for_event[bin_time].items() if score == 1)
-                            exact_start = min((event[0] for scorer, events in all_events.items() 
-                               for event in events if event[0].replace(microsecond=0) == bin_time),
-                              default=bin_time,
-                              key=time_only)
+                            exact_start = exact_starts.get(bin_time, bin_time)
                             one_tech_period_before.append((exact_start, bin_time))
                         else:
                             one_tech_period_before.append((bin_time, bin_time))
@@ -199,101 +201,164 @@ def reconcile_study(study_path, output_dir):
                         if not one_tech_period_after:
                             # Find the exact start time for this period
                             scorer = next(scorer for scorer, score in bin_scores_for_event[bin_time].items() if score == 1)
-                            exact_start = min((event[0] for scorer, events in all_events.items() 
-                               for event in events if event[0].replace(microsecond=0) == bin_time),
-                              default=bin_time,
-                              key=time_only)
+                            exact_start = exact_starts.get(bin_time, bin_time)
                             one_tech_period_after.append((exact_start, bin_time))
                         else:
                             one_tech_period_after.append((bin_time, bin_time))
 
             # Add events for periods longer than 10 seconds
             for period in [one_tech_period_before, one_tech_period_after]:
-                if period and len(period) > 10:  # More than 10 seconds
+                if period and len(period) > SINGLE_SCORER_MIN_SECONDS:  # More than 10 seconds
                     scorer = next(scorer for scorer, score in bin_scores_for_event[period[0][1]].items() if score == 1)
                     description = get_detailed_description({scorer: 'Arousal', **{s: 'No Arousal' for s in scorers if s != scorer}})
                     final_events.append([period[0][0], period[-1][1], description])
         else:
             # If no period is scored by at least two techs, mark the entire event for review
-            exact_start = min((event[0] for scorer, events in all_events.items() 
-                               for event in events if event[0].replace(microsecond=0) == event_bins[0]),
-                              default=event_bins[0],
-                              key=time_only)
-            exact_end = max((event[1] for scorer, events in all_events.items() 
-                             for event in events if event[1].replace(microsecond=0) == event_bins[-1]),
-                            default=event_bins[-1],
-                            key=time_only)
+            exact_start = exact_starts.get(event_bins[0], event_bins[0])
+            exact_end = exact_ends.get(event_bins[-1], event_bins[-1])
             description = get_detailed_description({scorer: 'Arousal' if any(bin_scores_for_event[bin_time][scorer] for bin_time in event_bins) else 'No Arousal' for scorer in scorers})
             final_events.append([exact_start, exact_end, description])
 
-        print(f"Processed event {event_index + 1}: {event_bins[0]} - {event_bins[-1]}")
-    
-    print(f"Final number of events: {len(final_events)}")
-    return final_events, study_start_time
+        if log_events:
+            event_logger.debug("Processed event %d: %s - %s", event_index + 1, event_bins[0], event_bins[-1])
+
+    end_phase('resolve')
+    return [[datetime_to_offset(study_start_time, start), datetime_to_offset(study_start_time, end), description]
+            for start, end, description in final_events]
+
+def reconcile_with_bitmask(all_events, study_start_time, last_event_end, counters=None):
+    """Reconcile parsed events on a uint8 occupancy array with one bit per scorer.
+
+    Produces the same events as reconcile_with_bins. Contiguous events, the period
+    scored by at least two techs and the single-tech periods around it are found
+    with array operations; only the exact boundary lookups remain per event.
+    """
+    if counters is None:
+        counters = Counter()
+    log_events = event_logger.isEnabledFor(logging.DEBUG)
+    def to_datetime(ms):
+        return offset_to_datetime(study_start_time, ms)
+
+    n_bins = max(last_event_end // 1000 + 1, 0)
+    occupancy = np.zeros(n_bins, dtype=np.uint8)
+
+    first_start, last_end = build_boundary_index(all_events, bin_of=second_of_ms, key=None)
+
+    for bit, scorer in enumerate(SCORERS):
+        for start_ms, end_ms, _ in all_events.get(scorer, []):
+            if end_ms < start_ms:
+                continue
+            # An event covers the bins reached in whole seconds from its start
+            start_bin = start_ms // 1000
+            lo = max(start_bin, 0)
+            hi = min(start_bin + (end_ms - start_ms) // 1000, n_bins - 1)
+            if lo <= hi:
+                occupancy[lo:hi + 1] |= 1 << bit
+
+    logger.debug("Created %d bins from %s to %s", n_bins, study_start_time, to_datetime(last_event_end))
+
+    score_sum = POPCOUNT[occupancy]
+    end_phase('bin')
+
+    # Group bins into contiguous events
+    edges = np.diff(np.concatenate(([0], (score_sum > 0).astype(np.int8), [0])))
+    event_starts = np.flatnonzero(edges == 1)
+    event_ends = np.flatnonzero(edges == -1) - 1
+    end_phase('group')
+    if event_starts.size == 0:
+        return []
+
+    # Per event: first and last bin scored by at least two techs, then the
+    # single-tech bins before and after that period
+    index = np.arange(n_bins)
+    event_of_bin = np.searchsorted(event_starts, index, side='right') - 1
+    two_techs = score_sum >= 2
+    start_two_techs = np.minimum.reduceat(np.where(two_techs, index, n_bins), event_starts)
+    end_two_techs = np.maximum.reduceat(np.where(two_techs, index, -1), event_starts)
+
+    one_tech = score_sum == 1
+    before = one_tech & (index < start_two_techs[event_of_bin])
+    after = one_tech & (index > end_two_techs[event_of_bin])
+    before_first = np.minimum.reduceat(np.where(before, index, n_bins), event_starts)
+    before_last = np.maximum.reduceat(np.where(before, index, -1), event_starts)
+    before_count = np.add.reduceat(before.astype(np.int64), event_starts)
+    after_first = np.minimum.reduceat(np.where(after, index, n_bins), event_starts)
+    after_last = np.maximum.reduceat(np.where(after, index, -1), event_starts)
+    after_count = np.add.reduceat(after.astype(np.int64), event_starts)
+
+    def describe(bin_index):
+        mask = occupancy[bin_index]
+        return get_detailed_description({scorer: 'Arousal' if mask & (1 << bit) else 'No Arousal' for bit, scorer in enumerate(SCORERS)})
+
+    final_events = []
+
+    for event_index in range(event_starts.size):
+        first_bin, last_bin = int(event_starts[event_index]), int(event_ends[event_index])
+
+        if end_two_techs[event_index] >= 0:
+            start_bin, end_bin = int(start_two_techs[event_index]), int(end_two_techs[event_index])
+            exact_start = first_start.get(start_bin, start_bin * 1000)
+            exact_end = last_end.get(end_bin, end_bin * 1000)
+
+            if exact_end == end_bin * 1000:
+                counters['boundary_misses'] += 1
+                if log_events:
+                    event_logger.debug("No exact end time found for event %d. Using bin time: %s", event_index, to_datetime(exact_end))
+
+            # Add the event scored by at least two techs
+            final_events.append([exact_start, exact_end, "Arousal"])
+
+            # Add events for single-tech periods longer than 10 seconds
+            for count, period_first, period_last in [(before_count, before_first, before_last), (after_count, after_first, after_last)]:
+                if count[event_index] > SINGLE_SCORER_MIN_SECONDS:
+                    period_start, period_end = int(period_first[event_index]), int(period_last[event_index])
+                    exact_start = first_start.get(period_start, period_start * 1000)
+                    final_events.append([exact_start, period_end * 1000, describe(period_start)])
+        else:
+            # If no period is scored by at least two techs, mark the entire event for review
+            exact_start = first_start.get(first_bin, first_bin * 1000)
+            exact_end = last_end.get(last_bin, last_bin * 1000)
+            final_events.append([exact_start, exact_end, describe(first_bin)])
+
+        if log_events:
+            event_logger.debug("Processed event %d: %s - %s", event_index + 1, to_datetime(first_bin * 1000), to_datetime(last_bin * 1000))
+
+    end_phase('resolve')
+    return final_events
 
 def get_detailed_description(scores):
     return "Review: Arousal"
 
-def process_study(study_path, output_dir):
-    study_name = os.path.basename(study_path)
-    output_csv = os.path.join(output_dir, f"{study_name}_arousal_reconciliation_no_label.csv")
-    error_log = os.path.join(output_dir, "error_log.txt")
-
-    try:
-        final_events, study_start_time = reconcile_study(study_path, output_dir)
-
-        with open(output_csv, 'w', newline='') as csvfile:
-            csvwriter = csv.writer(csvfile, delimiter='\t')
-            csvwriter.writerow(['Onset', 'Duration', 'Description'])
-
-            for start, end, description in final_events:
-                onset = start.strftime("%Y-%m-%dT%H:%M:%S.%f")[:-3]
-                duration = (end - start).total_seconds()
-                csvwriter.writerow([onset, f"{duration:.2f}", description])
-
-        print(f"Successfully processed study: {study_name}")
-        return output_csv, None
-    except Exception as e:
-        error_message = f"Error processing {study_name}: {str(e)}"
-        print(error_message)
-        with open(error_log, 'a') as f:
-            f.write(f"{datetime.now()}: {error_message}\n")
-        return None, error_message
-
-def process_all_studies(data_path, output_dir):
-    if not os.path.exists(output_dir):
-        os.makedirs(output_dir)
-
-    processed_files = []
-    failed_studies = []
-
-    for study in os.listdir(data_path):
-        study_path = os.path.join(data_path, study)
-        if os.path.isdir(study_path):
-            output_csv, error = process_study(study_path, output_dir)
-            if output_csv:
-                processed_files.append(output_csv)
-            if error:
-                failed_studies.append((study, error))
-
-    # Print summary
-    print(f"\nProcessing Summary:")
-    print(f"Successfully processed: {len(processed_files)} studies")
-    print(f"Failed: {len(failed_studies)} studies")
-    if failed_studies:
-        print("\nFailed studies:")
-        for study, error in failed_studies:
-            print(f"- {study}: {error}")
-    print(f"\nCSV files created in: {output_dir}")
-    print(f"See error_log.txt for detailed error information")
-
-    return processed_files, failed_studies
-
-# Helper function to compare only time components
-def time_only(dt):
-    return dt.time()
+# Reconciliation engines, selectable with the engine argument
+ENGINES = {
+    'bins': reconcile_with_bins,
+    'bitmask': reconcile_with_bitmask,
+}
+
+# What the batch driver in reconciliation/common.py needs to know about arousal events
+EVENTS = {
+    'name': 'arousal',
+    'scorers': SCORERS,
+    'reconcile': reconcile_study,
+    'file_name': 'Classification Arousals.txt',
+    'output_suffix': '_arousal_reconciliation_no_label.csv',
+    'params': {'single_scorer_min_seconds': SINGLE_SCORER_MIN_SECONDS},
+}
+
+def process_study(study_path, output_dir, engine='bins', counters=None):
+    return process_event_study(study_path, output_dir, EVENTS, engine, counters)
+
+def process_all_studies(data_path, output_dir, engine='bins', jobs=1, incremental=True):
+    """Process every study in data_path. With incremental, studies whose scorer files and
+    parameters match the manifest next to output_dir are skipped."""
+    return process_event_studies(data_path, output_dir, EVENTS, engine, jobs, incremental)
 
 # Usage
-data_path = 'data_all'
-output_dir = 'output/arousal_reconciliation_output'
-processed_files, failed_studies = process_all_studies(data_path, output_dir)
+if __name__ == "__main__":
+    configure_logging(logging.INFO, event_details=False)  # Set event_details=True for per-event diagnostics
+    data_path = 'data_all'
+    output_dir = 'output/arousal_reconciliation_output'
+    engine = 'bitmask'  # Set to 'bins' for the original per-second reconciliation
+    jobs = 1  # Number of studies to process in parallel
+    incremental = True  # Set to False to reprocess studies whose inputs have not changed
+    processed_files, failed_studies = process_all_studies(data_path, output_dir, engine, jobs, incremental)
@@ -0,0 +1,261 @@
+import os
+import re
+import csv
+import time
+from collections import Counter
+from datetime import datetime
+
+from utils.batch import append_error_log, map_in_pool
+from utils.manifest import fingerprint_inputs, forget_output, is_up_to_date, load_manifest, record_output, recorded_summary, save_manifest
+from utils.phases import end_phase, study_phases
+from utils.progress import format_counters, get_logger, sum_counters
+from utils.timecodes import clock_to_ms, datetime_to_clock_ms, event_offsets, offset_to_datetime
+
+START_TIME_PATTERN = re.compile(r'Start Time:\s*(.*)')
+# Time range, duration and separators in front of an event type
+EVENT_HEAD_PATTERN = re.compile(r'(\d{2}:\d{2}:\d{2},\d{3})-(\d{2}:\d{2}:\d{2},\d{3});\s*(\d+);\s*')
+# Start of the next time range, which ends the current event type
+EVENT_BOUNDARY_PATTERN = re.compile(r'\d{2}:\d{2}:\d{2},\d{3}-')
+
+logger = get_logger('parse')
+
+def parse_event_file(file_path):
+    """Parse a scorer event export (e.g. Flow Events.txt) into (start, end, event_type) datetimes"""
+    events_ms, start_time = parse_event_file_ms(file_path)
+    events = [(offset_to_datetime(start_time, start), offset_to_datetime(start_time, end), event_type)
+              for start, end, event_type in events_ms]
+    return events, start_time
+
+def parse_event_file_ms(file_path):
+    """Parse a scorer event export into (start_ms, end_ms, event_type) tuples.
+
+    Times are integer milliseconds since the file's Start Time, which is returned
+    alongside the events.
+    """
+    with open(file_path, 'r') as f:
+        start_time = read_start_time(f)
+        events = list(iter_events_ms(f, start_time))
+
+    logger.debug("Total events processed: %d in %s", len(events), file_path)
+    return events, start_time
+
+def read_scorer_files(study_path, file_name, scorers):
+    """Parse file_name from each scorer folder of a study into {scorer: (events_ms, start_time)}.
+
+    Scorers without the file are left out.
+    """
+    scorer_files = {}
+    for scorer in scorers:
+        file_path = os.path.join(study_path, scorer, file_name)
+        if not os.path.exists(file_path):
+            logger.info("File not found for scorer %s: %s", scorer, file_path)
+            continue  # Skip if the file doesn't exist
+        scorer_files[scorer] = parse_event_file_ms(file_path)
+    return scorer_files
+
+def format_event_rows(final_events, study_start_time):
+    """Format reconciled (start_ms, end_ms, description) events as Onset, Duration, Description rows"""
+    rows = []
+    for start, end, description in final_events:
+        onset = offset_to_datetime(study_start_time, start).strftime("%Y-%m-%dT%H:%M:%S.%f")[:-3]
+        duration = (end - start) / 1000
+        rows.append([onset, f"{duration:.2f}", description])
+    return rows
+
+def read_start_time(lines):
+    """Consume header lines up to and including the Start Time line"""
+    for line in lines:
+        start_time_match = START_TIME_PATTERN.search(line)
+        if start_time_match:
+            start_time_str = start_time_match.group(1).strip()
+            return datetime.strptime(start_time_str, "%m/%d/%Y %I:%M:%S %p")
+    raise ValueError("Start Time not found in the file.")
+
+def iter_events_ms(lines, start_time):
+    """Yield events as (start_ms, end_ms, event_type) relative to start_time, handling midnight rollover"""
+    origin_clock_ms = datetime_to_clock_ms(start_time)
+    for start_str, end_str, event_type in iter_event_records(lines):
+        start, end = event_offsets(clock_to_ms(start_str), clock_to_ms(end_str), origin_clock_ms)
+        yield start, end, event_type
+
+def iter_event_records(lines):
+    """Yield (start_str, end_str, event_type) records from event lines.
+
+    Handles several events concatenated on one line and event types running on
+    into following lines, but only keeps the current unfinished record in memory
+    instead of the whole file.
+    """
+    pending = ''
+    waiting = False  # pending starts with a complete time range waiting for its event type to end
+    for line in lines:
+        pending += line
+        if not EVENT_BOUNDARY_PATTERN.search(line):
+            # Boundaries do not span lines, so this line can only extend the pending event
+            # type or complete the time range pending starts with; no need to search it all again
+            if not EVENT_BOUNDARY_PATTERN.match(pending):
+                pending = ''
+                continue
+            if waiting or not EVENT_HEAD_PATTERN.match(pending):
+                continue
+        pending = yield from split_event_records(pending, final=False)
+        waiting = EVENT_HEAD_PATTERN.match(pending) is not None
+    yield from split_event_records(pending, final=True)
+
+def split_event_records(text, final):
+    """Yield the complete records in text and return the unfinished remainder"""
+    position = 0
+    while True:
+        head = EVENT_HEAD_PATTERN.search(text, position)
+        if head is None:
+            break
+        boundary = EVENT_BOUNDARY_PATTERN.search(text, head.end())
+        if boundary is None and not final:
+            # The event type may continue on the next line
+            return text[head.start():]
+        end = boundary.start() if boundary else len(text)
+        yield head.group(1), head.group(2), text[head.end():end].strip()
+        if boundary is None:
+            return ''
+        position = boundary.start()
+
+    # Keep a time range whose duration or event type may follow on the next line
+    last_boundary = None
+    for last_boundary in EVENT_BOUNDARY_PATTERN.finditer(text, position):
+        pass
+    return text[last_boundary.start():] if last_boundary else ''
+
+def time_only(dt):
+    """Compare only the time components of a datetime"""
+    return dt.time()
+
+def truncate_to_second(dt):
+    return dt.replace(microsecond=0)
+
+def second_of_ms(ms):
+    return ms // 1000
+
+def build_boundary_index(all_events, bin_of=truncate_to_second, key=time_only):
+    """Index the earliest event start and latest event end per one-second bin.
+
+    Built once per study from the events of all scorers, so every exact start/end
+    lookup is a dict access instead of a scan over all events. bin_of maps a time to
+    its bin and key orders times within a bin (None compares them directly); ties
+    keep the first event, like min() and max(). Returns (starts, ends).
+    """
+    if key is None:
+        key = lambda value: value
+
+    starts = {}
+    ends = {}
+    for events in all_events.values():
+        for start, end, _ in events:
+            start_bin = bin_of(start)
+            if start_bin not in starts or key(start) < key(starts[start_bin]):
+                starts[start_bin] = start
+            end_bin = bin_of(end)
+            if end_bin not in ends or key(end) > key(ends[end_bin]):
+                ends[end_bin] = end
+    return starts, ends
+
+def study_output_csv(output_dir, study_name, events):
+    return os.path.join(output_dir, f"{study_name}{events['output_suffix']}")
+
+def process_event_study(study_path, output_dir, events, engine='bins', counters=None):
+    """Reconcile one study's events and write them to output_dir. events describes the kind
+    of events, like flow.EVENTS and arousal.EVENTS. Event counts are added to counters."""
+    if counters is None:
+        counters = Counter()
+    study_logger = get_logger(events['name'])
+    study_name = os.path.basename(study_path)
+    output_csv = study_output_csv(output_dir, study_name, events)
+    error_log = os.path.join(output_dir, "error_log.txt")
+
+    begin = time.perf_counter()
+    with study_phases(study_name, events['name']) as record:
+        counters_before = Counter(counters)
+        try:
+            final_events, study_start_time = events['reconcile'](study_path, output_dir, engine, counters=counters)
+
+            with open(output_csv, 'w', newline='') as csvfile:
+                csvwriter = csv.writer(csvfile, delimiter='\t')
+                csvwriter.writerow(['Onset', 'Duration', 'Description'])
+
+                csvwriter.writerows(format_event_rows(final_events, study_start_time))
+            end_phase('write')
+            # counters may hold totals of earlier studies; report this study's counts only
+            study_counters = counters - counters_before
+            if record is not None:
+                record['counters'] = dict(study_counters)
+
+            study_logger.info("%s: %s (%.2fs)", study_name, format_counters(study_counters), time.perf_counter() - begin)
+            return output_csv, None
+        except Exception as e:
+            error_message = f"Error processing {study_name}: {str(e)}"
+            study_logger.error(error_message)
+            append_error_log(error_log, error_message)
+            if record is not None:
+                record['error'] = error_message
+            return None, error_message
+
+def count_event_study(study_path, output_dir, events, engine='bins'):
+    """process_event_study for batch workers, also returning the study's counters"""
+    counters = Counter()
+    output_csv, error = process_event_study(study_path, output_dir, events, engine, counters)
+    return output_csv, error, counters
+
+def process_event_studies(data_path, output_dir, events, engine='bins', jobs=1, incremental=True):
+    """Process every study in data_path. With incremental, studies whose scorer files and
+    parameters match the manifest next to output_dir are skipped."""
+    study_logger = get_logger(events['name'])
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+
+    processed_files = []
+    failed_studies = []
+
+    # Studies are listed in sorted order so results do not depend on the pool's completion order
+    studies = [study for study in sorted(os.listdir(data_path)) if os.path.isdir(os.path.join(data_path, study))]
+
+    outputs = load_manifest(output_dir)
+    output_csvs = {}
+    fingerprints = {}
+    results = {}
+    for study in studies:
+        study_path = os.path.join(data_path, study)
+        output_csv = output_csvs[study] = study_output_csv(output_dir, study, events)
+        input_paths = [os.path.join(study_path, scorer, events['file_name']) for scorer in events['scorers']]
+        fingerprints[study] = fingerprint_inputs(outputs, output_csv, input_paths, events['params'])
+        # Skipped studies report the counters recorded when they were processed
+        summary = recorded_summary(outputs, output_csv)
+        if incremental and summary is not None and is_up_to_date(outputs, output_csv, fingerprints[study]):
+            results[study] = (output_csv, None, Counter(summary))
+            study_logger.info("Skipping unchanged study: %s (%s)", study, format_counters(results[study][2]))
+
+    pending = [study for study in studies if study not in results]
+    pending_results = map_in_pool(count_event_study, [os.path.join(data_path, study) for study in pending], jobs,
+                                  output_dir=output_dir, events=events, engine=engine)
+    results.update(zip(pending, pending_results))
+
+    for study in studies:
+        output_csv, error, counters = results[study]
+        if output_csv:
+            processed_files.append(output_csv)
+            record_output(outputs, output_csv, fingerprints[study], dict(counters))
+        if error:
+            failed_studies.append((study, error))
+            forget_output(outputs, output_csvs[study])
+    save_manifest(output_dir, outputs)
+
+    # Log summary
+    study_logger.info("Processing Summary:")
+    study_logger.info("Successfully processed: %d studies", len(processed_files))
+    study_logger.info("Failed: %d studies", len(failed_studies))
+    study_logger.info("Totals: %s", format_counters(sum_counters(counters for _, _, counters in results.values())))
+    if failed_studies:
+        study_logger.info("Failed studies:")
+        for study, error in failed_studies:
+            study_logger.info("- %s: %s", study, error)
+    study_logger.info("CSV files created in: %s", output_dir)
+    study_logger.info("See error_log.txt for detailed error information")
+
+    return processed_files, failed_studies
@@ -1,79 +1,58 @@
 import os
-from datetime import datetime, timedelta
-import csv
-import re
-
-def parse_event_file(file_path):
-    events = []
-    start_time = None
-    with open(file_path, 'r') as f:
-        content = f.read()
-
-    # Extract the Start Time
-    start_time_match = re.search(r'Start Time:\s*(.*)', content)
-    
-    if start_time_match:
-        start_time_str = start_time_match.group(1).strip()
-        start_time = datetime.strptime(start_time_str, "%m/%d/%Y %I:%M:%S %p")
-    else:
-        raise ValueError("Start Time not found in the file.")
-
-    # Handle concatenated events
-    event_pattern = r'(\d{2}:\d{2}:\d{2},\d{3}-\d{2}:\d{2}:\d{2},\d{3});\s*(\d+);\s*(.*?)(?=(\d{2}:\d{2}:\d{2},\d{3}-|$))'
-    matches = re.finditer(event_pattern, content, re.DOTALL)
-
-    for match in matches:
-        time_range = match.group(1)
-        duration = match.group(2)
-        event_type = match.group(3).strip()
-
-        start_str, end_str = time_range.split('-')
-
-        # Parse start and end times
-        start = datetime.strptime(start_str.strip(), '%H:%M:%S,%f')
-        end = datetime.strptime(end_str.strip(), '%H:%M:%S,%f')
-
-        # Adjust date components
-        start = start.replace(year=start_time.year, month=start_time.month, day=start_time.day)
-        end = end.replace(year=start_time.year, month=start_time.month, day=start_time.day)
-
-        # Handle events that cross midnight
-        if start.time() < start_time.time():
-            start += timedelta(days=1)
-        if end.time() < start_time.time() or end < start:
-            end += timedelta(days=1)
-
-        events.append((start, end, event_type))
-
-    print(f"\nTotal events processed: {len(events)}")
-    return events, start_time
-
-def reconcile_study(study_path, output_dir):
+import sys
+import logging
+from collections import Counter
+from datetime import timedelta
+import heapq
+
+if __package__ in (None, ''):
+    # Running as a script: make the src directory importable
+    sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from reconciliation.common import build_boundary_index, process_event_studies, process_event_study, read_scorer_files, second_of_ms
+from utils.batch import append_error_log
+from utils.phases import end_phase
+from utils.progress import configure_logging, flush_event_details, get_event_logger, get_logger
+from utils.timecodes import MS_PER_DAY, datetime_to_offset, offset_to_datetime
+
+SCORERS = ['LS', 'ES', 'MS']
+# Periods scored by a single scorer are only flagged for review when longer than this
+SINGLE_SCORER_MIN_SECONDS = 10
+
+logger = get_logger('flow')
+event_logger = get_event_logger()
+
+def reconcile_study(study_path, output_dir, engine='bins', scorer_files=None, counters=None):
+    """Reconcile a study's scorers. scorer_files can pass in already parsed files, as returned
+    by read_scorer_files, instead of reading them from study_path. Event counts are added to counters."""
+    if counters is None:
+        counters = Counter()
     error_log = os.path.join(output_dir, "error_log.txt")
-    scorers = ['LS', 'ES', 'MS']
+    scorers = SCORERS
     all_events = {}
+    file_start_times = {}
     study_start_time = None
 
-    print(f"Processing study: {study_path}")
+    logger.debug("Processing study: %s", study_path)
 
     # Parse events from each scorer
+    if scorer_files is None:
+        scorer_files = read_scorer_files(study_path, 'Flow Events.txt', scorers)
     event_counts = []  # Track number of events per scorer
     for scorer in scorers:
-        file_path = os.path.join(study_path, scorer, 'Flow Events.txt')
-        if not os.path.exists(file_path):
-            print(f"File not found for scorer {scorer}: {file_path}")
+        if scorer not in scorer_files:
             event_counts.append(0)
-            continue  # Skip if the file doesn't exist
-        events, start_time = parse_event_file(file_path)
+            continue
+        events, start_time = scorer_files[scorer]
         event_counts.append(len(events))
         if len(events) == 0:
-            with open(error_log, 'a') as f:
-                f.write(f"{datetime.now()}: WARNING - No events found for scorer {scorer}  in study {study_path} \n")
+            append_error_log(error_log, f"WARNING - No events found for scorer {scorer}  in study {study_path}")
             continue
         all_events[scorer] = events
+        file_start_times[scorer] = start_time
         if study_start_time is None or start_time < study_start_time:
             study_start_time = start_time
-        print(f"Parsed {len(events)} events for scorer {scorer}")
+        logger.debug("Parsed %d events for scorer %s", len(events), scorer)
 
     # Check if we have any events at all
     if not all_events:
@@ -82,7 +61,13 @@ def reconcile_study(study_path, output_dir):
     if sum(event_counts) == 0:
         raise ValueError(f"No events found in any scorer files. Event counts: {dict(zip(scorers, event_counts))}")
 
-    print(f"Study start time: {study_start_time}")
+    logger.debug("Study start time: %s", study_start_time)
+
+    # Express all events in milliseconds since the study start
+    for scorer, events in all_events.items():
+        offset = datetime_to_offset(study_start_time, file_start_times[scorer])
+        if offset:
+            all_events[scorer] = [(start + offset, end + offset, event_type) for start, end, event_type in events]
 
     # Get all bins where any scorer has an event - with error handling
     try:
@@ -90,19 +75,39 @@ def reconcile_study(study_path, output_dir):
     except ValueError:
         raise ValueError("No events found in any of the parsed files")
 
-    all_bins = []
-
     # If study start time and last event are more than 2 days apart, raise an error
-    if (last_event_end - study_start_time).days > 2:
-        raise ValueError(f"Study start time and last event are more than 2 days apart: {study_start_time} to {last_event_end}")
+    if last_event_end // MS_PER_DAY > 2:
+        raise ValueError(f"Study start time and last event are more than 2 days apart: {study_start_time} to {offset_to_datetime(study_start_time, last_event_end)}")
+
+    end_phase('parse')
+    final_events = ENGINES[engine](all_events, study_start_time, last_event_end, counters)
+    flush_event_details()
 
+    counters['events_parsed'] += sum(event_counts)
+    counters['events_reconciled'] += len(final_events)
+    counters['events_flagged'] += sum(1 for _, _, description in final_events if description.startswith('Review'))
+    logger.debug("Final number of events: %d", len(final_events))
+    return final_events, study_start_time
 
+def reconcile_with_bins(all_events, study_start_time, last_event_end, counters=None):
+    """Reconcile parsed events using one-second bins from study start to the last event end"""
+    if counters is None:
+        counters = Counter()
+    log_events = event_logger.isEnabledFor(logging.DEBUG)
+    scorers = SCORERS
+    # This engine works on datetimes; convert from and back to milliseconds since study start
+    all_events = {scorer: [(offset_to_datetime(study_start_time, start), offset_to_datetime(study_start_time, end), event_type)
+                           for start, end, event_type in events]
+                  for scorer, events in all_events.items()}
+    last_event_end = offset_to_datetime(study_start_time, last_event_end)
+    exact_starts, exact_ends = build_boundary_index(all_events)
+    all_bins = []
     current_time = study_start_time
     while current_time <= last_event_end:
         all_bins.append(current_time)
         current_time += timedelta(seconds=1)
     
-    print(f"Created {len(all_bins)} bins from {study_start_time} to {last_event_end}")
+    logger.debug("Created %d bins from %s to %s", len(all_bins), study_start_time, last_event_end)
 
     # Create a mapping from bin_time to scores and event types
     bin_scores = {}
@@ -116,6 +121,7 @@ def reconcile_study(study_path, output_dir):
                 if bin_time in bin_scores:
                     bin_scores[bin_time][scorer] = {'score': 1, 'event_type': event_type}
                 current += timedelta(seconds=1)
+    end_phase('bin')
 
     # Group bins into contiguous events
     events = []
@@ -131,6 +137,7 @@ def reconcile_study(study_path, output_dir):
                 current_event_bins = []
     if current_event_bins:
         events.append(current_event_bins)
+    end_phase('group')
 
     final_events = []
    
@@ -160,21 +167,17 @@ def reconcile_study(study_path, output_dir):
                     start_two_techs = bin_time
                     event_type = matching_event_type
                     # Find the earliest exact start time from original events
-                    exact_start = min((event[0] for scorer, events in all_events.items() 
-                                      for event in events if event[0].replace(microsecond=0) == bin_time),
-                                      key=time_only,
-                                      default=bin_time)
+                    exact_start = exact_starts.get(bin_time, bin_time)
                 end_two_techs = bin_time
         
         if start_two_techs and end_two_techs:
             # Find the exact end time
-            end_events = [event[1] for scorer, events in all_events.items() 
-                          for event in events if event[1].replace(microsecond=0) == end_two_techs]
-            
-            exact_end = max(end_events, key=time_only, default=end_two_techs)
+            exact_end = exact_ends.get(end_two_techs, end_two_techs)
             
             if exact_end == end_two_techs:
-                print(f"Info: No exact end time found for event {event_index}. Using bin time: {exact_end}")
+                counters['boundary_misses'] += 1
+                if log_events:
+                    event_logger.debug("No exact end time found for event %d. Using bin time: %s", event_index, exact_end)
             
             # Add the event scored by at least two techs with matching event types
             final_events.append([exact_start, exact_end, event_type])
@@ -190,10 +193,7 @@ def reconcile_study(study_path, output_dir):
                         if not one_tech_period_before:
                             # Find the exact start time for this period
                             scorer = next(scorer for scorer, s in scores.items() if s['score'] == 1)
-                            exact_start = min((event[0] for scorer, events in all_events.items() 
-                               for event in events if event[0].replace(microsecond=0) == bin_time),
-                              default=bin_time,
-                              key=time_only)
+                            exact_start = exact_starts.get(bin_time, bin_time)
                             one_tech_period_before.append((exact_start, bin_time))
                         else:
                             one_tech_period_before.append((bin_time, bin_time))
@@ -203,103 +203,198 @@ def reconcile_study(study_path, output_dir):
                         if not one_tech_period_after:
                             # Find the exact start time for this period
                             scorer = next(scorer for scorer, s in scores.items() if s['score'] == 1)
-                            exact_start = min((event[0] for scorer, events in all_events.items() 
-                               for event in events if event[0].replace(microsecond=0) == bin_time),
-                              default=bin_time,
-                              key=time_only)
+                            exact_start = exact_starts.get(bin_time, bin_time)
                             one_tech_period_after.append((exact_start, bin_time))
                         else:
                             one_tech_period_after.append((bin_time, bin_time))
 
             # Add events for periods longer than 10 seconds
             for period in [one_tech_period_before, one_tech_period_after]:
-                if period and len(period) > 10:  # More than 10 seconds
+                if period and len(period) > SINGLE_SCORER_MIN_SECONDS:  # More than 10 seconds
                     scores = bin_scores_for_event[period[0][1]]
                     description = get_detailed_description({scorer: scores[scorer]['event_type'] if scores[scorer]['score'] == 1 else None for scorer in scorers})
                     final_events.append([period[0][0], period[-1][1], description])
         else:
             # If no period is scored by at least two techs with matching event types, mark the entire event for review
-            exact_start = min((event[0] for scorer, events in all_events.items() 
-                               for event in events if event[0].replace(microsecond=0) == event_bins[0]),
-                              default=event_bins[0],
-                              key=time_only)
-            exact_end = max((event[1] for scorer, events in all_events.items() 
-                             for event in events if event[1].replace(microsecond=0) == event_bins[-1]),
-                            default=event_bins[-1],
-                            key=time_only)
+            exact_start = exact_starts.get(event_bins[0], event_bins[0])
+            exact_end = exact_ends.get(event_bins[-1], event_bins[-1])
             description = get_detailed_description({scorer: scores['event_type'] if any(bin_scores_for_event[bin_time][scorer]['score'] for bin_time in event_bins) else None for scorer, scores in bin_scores_for_event[event_bins[0]].items()})
             final_events.append([exact_start, exact_end, description])
 
-        print(f"Processed event {event_index + 1}: {event_bins[0]} - {event_bins[-1]}")
-    
-    print(f"Final number of events: {len(final_events)}")
-    return final_events, study_start_time
+        if log_events:
+            event_logger.debug("Processed event %d: %s - %s", event_index + 1, event_bins[0], event_bins[-1])
+
+    end_phase('resolve')
+    return [[datetime_to_offset(study_start_time, start), datetime_to_offset(study_start_time, end), description]
+            for start, end, description in final_events]
+
+def reconcile_with_sweep(all_events, study_start_time, last_event_end, counters=None):
+    """Reconcile parsed events by sweeping sorted scorer boundaries.
+
+    Produces the same events as reconcile_with_bins, but works on constant-score
+    segments between event boundaries instead of materializing every second of the
+    night. Times are integer milliseconds since study start, bins integer seconds.
+    """
+    if counters is None:
+        counters = Counter()
+    log_events = event_logger.isEnabledFor(logging.DEBUG)
+    def to_datetime(ms):
+        return offset_to_datetime(study_start_time, ms)
+
+    last_bin = last_event_end // 1000
+
+    first_start, last_end = build_boundary_index(all_events, bin_of=second_of_ms, key=None)
+
+    scorer_segments = {}
+    for scorer, events in all_events.items():
+        intervals = []
+        for index, (start_ms, end_ms, event_type) in enumerate(events):
+            if end_ms < start_ms:
+                continue
+            # An event covers the bins reached in whole seconds from its start
+            start_bin = start_ms // 1000
+            lo = max(start_bin, 0)
+            hi = min(start_bin + (end_ms - start_ms) // 1000, last_bin)
+            if lo <= hi:
+                intervals.append((lo, hi + 1, index, event_type))
+        scorer_segments[scorer] = coverage_segments(intervals)
+    end_phase('bin')
+
+    # Split the night at every boundary and record each scorer's event type per segment
+    points = sorted({point for segments in scorer_segments.values() for a, b, _ in segments for point in (a, b)})
+    positions = {scorer: 0 for scorer in SCORERS}
+    runs = []
+    current_run = []
+    for a, b in zip(points, points[1:]):
+        state = []
+        for scorer in SCORERS:
+            segments = scorer_segments.get(scorer, [])
+            position = positions[scorer]
+            while position < len(segments) and segments[position][1] <= a:
+                position += 1
+            positions[scorer] = position
+            covered = position < len(segments) and segments[position][0] <= a
+            state.append(segments[position][2] if covered else None)
+        if any(event_type is not None for event_type in state):
+            current_run.append((a, b, tuple(state)))
+        elif current_run:
+            runs.append(current_run)
+            current_run = []
+    if current_run:
+        runs.append(current_run)
+    end_phase('group')
+
+    final_events = []
+
+    for event_index, run in enumerate(runs):
+        run_start, run_end = run[0][0], run[-1][1] - 1
+        segments = [(a, b, state) + classify_segment(state) for a, b, state in run]
+
+        # Find the start and end of the period scored by at least two techs with matching event types
+        matching = [segment for segment in segments if segment[4] >= 2]
+
+        if matching:
+            start_two_techs = matching[0][0]
+            end_two_techs = matching[-1][1] - 1
+            event_type = matching[0][3]
+            exact_start = first_start.get(start_two_techs, start_two_techs * 1000)
+            exact_end = last_end.get(end_two_techs, end_two_techs * 1000)
+
+            if exact_end == end_two_techs * 1000:
+                counters['boundary_misses'] += 1
+                if log_events:
+                    event_logger.debug("No exact end time found for event %d. Using bin time: %s", event_index, to_datetime(exact_end))
+
+            final_events.append([exact_start, exact_end, event_type])
+
+            # Periods scored by only one tech or with different event types, before and after
+            before = [(a, min(b, start_two_techs), state) for a, b, state, _, _, review in segments if review and a < start_two_techs]
+            after = [(max(a, end_two_techs + 1), b, state) for a, b, state, _, _, review in segments if review and b - 1 > end_two_techs]
+
+            # Add events for periods longer than 10 seconds
+            for period in [before, after]:
+                if period and sum(b - a for a, b, _ in period) > SINGLE_SCORER_MIN_SECONDS:
+                    first_bin, state = period[0][0], period[0][2]
+                    period_start = first_start.get(first_bin, first_bin * 1000)
+                    description = get_detailed_description(dict(zip(SCORERS, state)))
+                    final_events.append([period_start, (period[-1][1] - 1) * 1000, description])
+        else:
+            # If no period is scored by at least two techs with matching event types, mark the entire event for review
+            exact_start = first_start.get(run_start, run_start * 1000)
+            exact_end = last_end.get(run_end, run_end * 1000)
+            description = get_detailed_description(dict(zip(SCORERS, run[0][2])))
+            final_events.append([exact_start, exact_end, description])
+
+        if log_events:
+            event_logger.debug("Processed event %d: %s - %s", event_index + 1, to_datetime(run_start * 1000), to_datetime(run_end * 1000))
+
+    end_phase('resolve')
+    return final_events
+
+def coverage_segments(intervals):
+    """Turn one scorer's (first_bin, end_bin, file_index, event_type) intervals into
+    non-overlapping (first_bin, end_bin, event_type) segments. Where events overlap,
+    the one later in the file wins, as it overwrites earlier bins in reconcile_with_bins."""
+    points = sorted({point for lo, hi, _, _ in intervals for point in (lo, hi)})
+    intervals = sorted(intervals)
+    active = []
+    segments = []
+    i = 0
+    for a, b in zip(points, points[1:]):
+        while i < len(intervals) and intervals[i][0] <= a:
+            lo, hi, index, event_type = intervals[i]
+            heapq.heappush(active, (-index, hi, event_type))
+            i += 1
+        while active and active[0][1] <= a:
+            heapq.heappop(active)
+        if active:
+            segments.append((a, b, active[0][2]))
+    return segments
+
+def classify_segment(state):
+    """Return (matching_event_type, matching_scores, needs_review) for per-scorer event types"""
+    current_event_types = [event_type for event_type in state if event_type is not None]
+    event_type_counts = {et: current_event_types.count(et) for et in set(current_event_types)}
+    matching_event_type = max(event_type_counts, key=event_type_counts.get, default=None)
+    matching_scores = event_type_counts.get(matching_event_type, 0) if matching_event_type else 0
+    needs_review = len(current_event_types) == 1 or len(set(current_event_types)) > 1
+    return matching_event_type, matching_scores, needs_review
 
 def get_detailed_description(scores):
     # Get the first non-None event type and cut it to the first 5 characters
     event_type = next((score for score in scores.values() if score is not None), "Review")
     return f"Review: {event_type[:5]}"
 
-def process_study(study_path, output_dir):
-    study_name = os.path.basename(study_path)
-    output_csv = os.path.join(output_dir, f"{study_name}_flow_reconciliation.csv")
-    error_log = os.path.join(output_dir, "error_log.txt")
-
-    try:
-        final_events, study_start_time = reconcile_study(study_path, output_dir)
-
-        with open(output_csv, 'w', newline='') as csvfile:
-            csvwriter = csv.writer(csvfile, delimiter='\t')
-            csvwriter.writerow(['Onset', 'Duration', 'Description'])
-
-            for start, end, description in final_events:
-                onset = start.strftime("%Y-%m-%dT%H:%M:%S.%f")[:-3]
-                duration = (end - start).total_seconds()
-                csvwriter.writerow([onset, f"{duration:.2f}", description])
-
-        print(f"Successfully processed study: {study_name}")
-        return output_csv, None
-    except Exception as e:
-        error_message = f"Error processing {study_name}: {str(e)}"
-        print(error_message)
-        with open(error_log, 'a') as f:
-            f.write(f"{datetime.now()}: {error_message}\n")
-        return None, error_message
-
-def process_all_studies(data_path, output_dir):
-    if not os.path.exists(output_dir):
-        os.makedirs(output_dir)
-
-    processed_files = []
-    failed_studies = []
-
-    for study in os.listdir(data_path):
-        study_path = os.path.join(data_path, study)
-        if os.path.isdir(study_path):
-            output_csv, error = process_study(study_path, output_dir)
-            if output_csv:
-                processed_files.append(output_csv)
-            if error:
-                failed_studies.append((study, error))
-
-    # Print summary
-    print(f"\nProcessing Summary:")
-    print(f"Successfully processed: {len(processed_files)} studies")
-    print(f"Failed: {len(failed_studies)} studies")
-    if failed_studies:
-        print("\nFailed studies:")
-        for study, error in failed_studies:
-            print(f"- {study}: {error}")
-    print(f"\nCSV files created in: {output_dir}")
-    print(f"See error_log.txt for detailed error information")
-
-    return processed_files, failed_studies
-
-def time_only(dt):
-    return dt.time()
+# Reconciliation engines, selectable with the engine argument
+ENGINES = {
+    'bins': reconcile_with_bins,
+    'sweep': reconcile_with_sweep,
+}
+
+# What the batch driver in reconciliation/common.py needs to know about flow events
+EVENTS = {
+    'name': 'flow',
+    'scorers': SCORERS,
+    'reconcile': reconcile_study,
+    'file_name': 'Flow Events.txt',
+    'output_suffix': '_flow_reconciliation.csv',
+    'params': {'single_scorer_min_seconds': SINGLE_SCORER_MIN_SECONDS},
+}
+
+def process_study(study_path, output_dir, engine='bins', counters=None):
+    return process_event_study(study_path, output_dir, EVENTS, engine, counters)
+
+def process_all_studies(data_path, output_dir, engine='bins', jobs=1, incremental=True):
+    """Process every study in data_path. With incremental, studies whose scorer files and
+    parameters match the manifest next to output_dir are skipped."""
+    return process_event_studies(data_path, output_dir, EVENTS, engine, jobs, incremental)
 
 # Usage
-data_path = 'data_all'
-output_dir = 'output/flow_reconciliation_output'
-processed_files, failed_studies = process_all_studies(data_path, output_dir)
-
+if __name__ == "__main__":
+    configure_logging(logging.INFO, event_details=False)  # Set event_details=True for per-event diagnostics
+    data_path = 'data_all'
+    output_dir = 'output/flow_reconciliation_output'
+    engine = 'sweep'  # Set to 'bins' for the original per-second reconciliation
+    jobs = 1  # Number of studies to process in parallel
+    incremental = True  # Set to False to reprocess studies whose inputs have not changed
+    processed_files, failed_studies = process_all_studies(data_path, output_dir, engine, jobs, incremental)
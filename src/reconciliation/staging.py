@@ -1,17 +1,133 @@
-import pandas as pd
 import os
+import sys
 from pathlib import Path
 import csv
 import re
+from functools import lru_cache
+import numpy as np
 
-def analyze_agreement_and_generate_simplified_annotations(file_path, output_dir, require_full_agreement=False):
-    # Read the CSV file
-    df = pd.read_csv(file_path, sep=';')
+if __package__ in (None, ''):
+    # Running as a script: make the src directory importable
+    sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.agreement import add_file_agreement, fleiss_kappa, merge_agreement_stats, new_agreement_stats, pair_agreement, review_quantile, stage_agreement
+from utils.batch import map_in_pool
+from utils.phases import end_phase, study_phases
+from utils.stage_runs import collapse_stage_runs
+from utils.manifest import fingerprint_inputs, forget_output, is_up_to_date, load_manifest, record_output, recorded_summary, save_manifest
+
+def analyze_agreement_and_generate_simplified_annotations(file_path, output_dir, require_full_agreement=False, collapse_runs=False, agreement=None):
+    """Write the stage annotations of a scorer CSV and return its disagreement, partial agreement
+    and epoch counts. The file's agreement statistics are added to agreement, if given."""
+    with study_phases(Path(file_path).stem, 'staging') as record:
+        # Read the scorer columns of the CSV file
+        df = read_stage_scores(file_path)
+        end_phase('parse')
+    
+        annotations, rows_with_disagreement, rows_with_partial_agreement = generate_stage_annotations(df, require_full_agreement)
+        total_epochs = len(annotations)
+        if agreement is not None:
+            es_score, ms_score, ls_score = df[list(find_scorer_columns(tuple(df.columns)))].to_numpy().T
+            add_file_agreement(agreement, es_score, ms_score, ls_score, rows_with_disagreement)
+        if collapse_runs:
+            # One row per run of the same stage; review epochs keep their own rows
+            annotations = collapse_stage_runs(annotations)
+        end_phase('resolve')
     
+        # Ensure the output directory exists
+        os.makedirs(output_dir, exist_ok=True)
+    
+        # Create annotations CSV file
+        output_file = os.path.join(output_dir, f"{Path(file_path).stem}_stage_annotations.csv")
+        with open(output_file, 'w', newline='', encoding='utf-8') as f:
+            writer = csv.writer(f, delimiter='\t')
+            writer.writerow(['Onset', 'Duration', 'Description'])  # Header
+            writer.writerows(annotations)
+        end_phase('write')
+        if record is not None:
+            record['counters'] = {'epochs': total_epochs, 'epochs_disagreement': rows_with_disagreement,
+                                  'epochs_partial_agreement': rows_with_partial_agreement}
+    
+        return rows_with_disagreement, rows_with_partial_agreement, total_epochs
+
+def read_stage_scores(file_path):
+    """Read only the ES, MS and LS columns of a scorer CSV, in that order.
+
+    The columns are found from the header line, so the other columns of wide
+    exports are never parsed. Text columns are stored as categoricals.
+    """
+    # pandas is imported here so pool workers and other importers of this module start quickly
+    import pandas as pd
+
+    with open(file_path, newline='', encoding='utf-8-sig') as f:
+        header = next(csv.reader(f, delimiter=';'), [])
+    if not header or len(set(header)) < len(header):
+        # Let pandas raise for empty files and rename duplicate columns as it would
+        header = pd.read_csv(file_path, sep=';', nrows=0).columns
+    scorer_columns = list(find_scorer_columns(tuple(header)))
+    df = pd.read_csv(file_path, sep=';', usecols=scorer_columns)[scorer_columns]
+    return df.astype({col: 'category' for col in scorer_columns if df[col].dtype == object})
+
+def generate_stage_annotations(df, require_full_agreement=False):
+    """Build [onset, duration, description] epoch annotations from a scorer CSV's dataframe.
+
+    Returns the annotations with the number of epochs without and with partial agreement.
+    """
+    # Select the columns
+    df_scores = df[list(find_scorer_columns(tuple(df.columns)))]
+    
+    epoch_duration = 30  # Assuming 30-second epochs, adjust if different
+
+    # Same values as iterrows would give, upcast to a common dtype
+    es_score, ms_score, ls_score = df_scores.to_numpy().T
+    onsets = (df_scores.index * epoch_duration).tolist()
+
+    # Scores are "the same" for the unique-score count as they are in a set: equal or identical
+    same_es_ms = scores_match(es_score, ms_score)
+    same_es_ls = scores_match(es_score, ls_score)
+    same_ms_ls = scores_match(ms_score, ls_score)
+
+    # Number of unique scores per epoch, following how a set of the three scores is built
+    full = same_es_ms & same_es_ls
+    two_unique = (same_es_ms & ~same_es_ls) | (~same_es_ms & (same_es_ls | same_ms_ls))
+    partial = two_unique if not require_full_agreement else np.zeros(len(onsets), dtype=bool)
+
+    # Majority score for partial agreement; the loop version compared with == here, so NaN never matches
+    labels = np.full(len(onsets), "-", dtype=object)
+    labels[partial & (ms_score == ls_score)] = ms_score[partial & (ms_score == ls_score)]
+    es_majority = partial & ((es_score == ms_score) | (es_score == ls_score))
+    labels[es_majority] = es_score[es_majority]
+    labels[full] = es_score[full]
+
+    descriptions = ["Stage: " + label for label in labels.astype(str)]
+    annotations = [[onset, epoch_duration, description] for onset, description in zip(onsets, descriptions)]
+
+    rows_with_partial_agreement = int(partial.sum())
+    rows_with_disagreement = len(annotations) - int(full.sum()) - rows_with_partial_agreement
+
+    return annotations, rows_with_disagreement, rows_with_partial_agreement
+
+def scores_match(scores_a, scores_b):
+    """Elementwise a == b, counting identical objects as equal as a set does (e.g. pandas' NaN)"""
+    # pandas is imported here so pool workers and other importers of this module start quickly
+    import pandas as pd
+
+    matches = np.asarray(scores_a == scores_b, dtype=bool)
+    if scores_a.dtype == object:
+        for index in np.flatnonzero(~matches & pd.isna(scores_a) & pd.isna(scores_b)):
+            matches[index] = scores_a[index] is scores_b[index]
+    return matches
+
+@lru_cache(maxsize=None)
+def find_scorer_columns(columns):
+    """Return the (ES, MS, LS) column names for a tuple of CSV column names.
+
+    Exports from the same software share a layout, so the result is cached per header.
+    """
     # Find columns containing the strings
-    es_cols = [col for col in df.columns if 'ES' in col]
-    ms_cols = [col for col in df.columns if 'MS' in col]
-    ls_cols = [col for col in df.columns if 'LS' in col]
+    es_cols = [col for col in columns if 'ES' in col]
+    ms_cols = [col for col in columns if 'MS' in col]
+    ls_cols = [col for col in columns if 'LS' in col]
     
     # Check for duplicate matches
     if len(es_cols) > 1 or len(ms_cols) > 1 or len(ls_cols) > 1:
@@ -34,106 +150,84 @@ def analyze_agreement_and_generate_simplified_annotations(file_path, output_dir,
     
     # Check if all required columns were found
     if not (len(es_cols) == 1 and len(ms_cols) == 1 and len(ls_cols) == 1):
-        ls_cols = [col for col in df.columns if 'AS - ls' in col]
+        ls_cols = [col for col in columns if 'AS - ls' in col]
 
         if not (len(es_cols) == 1 and len(ms_cols) == 1 and len(ls_cols) == 1):
             raise ValueError(f"Missing required scorer columns: ES={es_cols}, MS={ms_cols}, LS={ls_cols}")
     
-    # Select the columns
-    df_scores = df[[es_cols[0], ms_cols[0], ls_cols[0]]]
-    
-    # Ensure the output directory exists
-    os.makedirs(output_dir, exist_ok=True)
-    
-    # Prepare annotations list
-    annotations = []
-    epoch_duration = 30  # Assuming 30-second epochs, adjust if different
-
-    rows_with_disagreement = 0
-    rows_with_partial_agreement = 0
+    return es_cols[0], ms_cols[0], ls_cols[0]
 
-    for index, row in df_scores.iterrows():
-        es_score = row[es_cols[0]]
-        ms_score = row[ms_cols[0]]
-        ls_score = row[ls_cols[0]]
-        
-        # Get all unique scores in this row
-        unique_scores = set([es_score, ms_score, ls_score])
-        
-        # Calculate onset time
-        onset = index * epoch_duration
-        duration = epoch_duration
-        
-        if len(unique_scores) == 1:
-            # All scorers agree
-            description = f"Stage: {es_score}"
-            annotations.append([onset, duration, description])
-        elif len(unique_scores) == 2 and not require_full_agreement:
-            # Two scorers agree - find the majority score
-            rows_with_partial_agreement += 1
-            
-            if es_score == ms_score:
-                majority_score = es_score
-            elif es_score == ls_score:
-                majority_score = es_score
-            elif ms_score == ls_score:
-                majority_score = ms_score
-            else:
-                # This should never happen when len(unique_scores) == 2
-                majority_score = "-"
-                
-            description = f"Stage: {majority_score}"
-            annotations.append([onset, duration, description])
-        else:
-            # No agreement (or only partial agreement but full agreement required)
-            rows_with_disagreement += 1
-            description = "Stage: -"
-            annotations.append([onset, duration, description])
-    
-    # Create annotations CSV file
-    output_file = os.path.join(output_dir, f"{Path(file_path).stem}_stage_annotations.csv")
-    with open(output_file, 'w', newline='', encoding='utf-8') as f:
-        writer = csv.writer(f, delimiter='\t')
-        writer.writerow(['Onset', 'Duration', 'Description'])  # Header
-        writer.writerows(annotations)
-    
-    return rows_with_disagreement, rows_with_partial_agreement, len(df_scores)
+def process_file(file_path, output_dir, require_full_agreement=False, collapse_runs=False):
+    filename = os.path.basename(file_path)
+    agreement = new_agreement_stats()
+    try:
+        disagreement_count, partial_agreement_count, total_epochs = analyze_agreement_and_generate_simplified_annotations(
+            file_path, output_dir, require_full_agreement, collapse_runs, agreement)
+        print(f"Processed {filename}")
+        return filename, disagreement_count, partial_agreement_count, total_epochs, agreement
+    except Exception as e:
+        print(f"Error processing {filename}: {str(e)}")
+        return None
 
-def process_all_files(data_dir, output_dir, require_full_agreement=False):
-    results = []
+def process_all_files(data_dir, output_dir, require_full_agreement=False, jobs=1, incremental=True, collapse_runs=False):
+    """Process every scorer CSV in data_dir. With incremental, files whose contents and
+    options match the manifest next to output_dir are skipped. With collapse_runs, consecutive
+    epochs of the same stage are written as one row."""
+    file_paths = []
     
-    for study_folder in os.listdir(data_dir):
+    # Folders and files are listed in sorted order so results do not depend on the pool's completion order
+    for study_folder in sorted(os.listdir(data_dir)):
         print(f"Processing {study_folder}")
         study_path = os.path.join(data_dir, study_folder)
         if os.path.isdir(study_path):
-            for filename in os.listdir(study_path):
+            for filename in sorted(os.listdir(study_path)):
                 if re.match(r'[A-Za-z]{3}\d{2,3}', filename) and filename.endswith('.csv'):
-                    file_path = os.path.join(study_path, filename)
-                    try:
-                        disagreement_count, partial_agreement_count, total_epochs = analyze_agreement_and_generate_simplified_annotations(
-                            file_path, output_dir, require_full_agreement)
-                        results.append((filename, disagreement_count, partial_agreement_count, total_epochs))
-                        print(f"Processed {filename}")
-                    except Exception as e:
-                        print(f"Error processing {filename}: {str(e)}")
+                    file_paths.append(os.path.join(study_path, filename))
                 else:
                     print(f"Skipping {filename}")
         else:
             print(f"Skipping {study_folder}")
     
-    return results
+    outputs = load_manifest(output_dir)
+    params = {'require_full_agreement': require_full_agreement, 'collapse_runs': collapse_runs}
+    output_files = {}
+    fingerprints = {}
+    results = {}
+    for file_path in file_paths:
+        output_file = output_files[file_path] = os.path.join(output_dir, f"{Path(file_path).stem}_stage_annotations.csv")
+        fingerprints[file_path] = fingerprint_inputs(outputs, output_file, [file_path], params)
+        summary = recorded_summary(outputs, output_file)
+        if incremental and summary and is_up_to_date(outputs, output_file, fingerprints[file_path]):
+            print(f"Skipping unchanged {os.path.basename(file_path)}")
+            results[file_path] = (os.path.basename(file_path), *summary)
+
+    pending = [file_path for file_path in file_paths if file_path not in results]
+    pending_results = map_in_pool(process_file, pending, jobs, output_dir=output_dir, require_full_agreement=require_full_agreement,
+                                  collapse_runs=collapse_runs)
+    results.update(zip(pending, pending_results))
+
+    for file_path in file_paths:
+        if results[file_path] is None:
+            forget_output(outputs, output_files[file_path])
+        else:
+            record_output(outputs, output_files[file_path], fingerprints[file_path], list(results[file_path][1:]))
+    if file_paths:
+        save_manifest(output_dir, outputs)
+
+    return [results[file_path] for file_path in file_paths if results[file_path] is not None]
 
 def print_results(results, require_full_agreement=False):
     total_epochs_all = 0
     total_disagreement_all = 0
     total_partial_agreement_all = 0
-    disagreement_percentages = []
+    # Agreement statistics are merged file by file, so the summary takes the same memory for any number of files
+    agreement = new_agreement_stats()
     
     # Print individual file results
-    for filename, disagreement_count, partial_agreement_count, total_epochs in results:
+    for filename, disagreement_count, partial_agreement_count, total_epochs, file_agreement in results:
         needing_review = disagreement_count if not require_full_agreement else (disagreement_count + partial_agreement_count)
         percentage = (needing_review / total_epochs) * 100 if total_epochs > 0 else 0
-        disagreement_percentages.append(percentage)
+        merge_agreement_stats(agreement, file_agreement)
         
         total_epochs_all += total_epochs
         total_disagreement_all += disagreement_count
@@ -161,23 +255,39 @@ def print_results(results, require_full_agreement=False):
         overall_percentage = (total_needing_review / total_epochs_all) * 100
         print(f"Overall percentage needing review: {overall_percentage:.2f}%")
     
-    if disagreement_percentages:
-        print(f"Average percentage needing review per file: {sum(disagreement_percentages) / len(disagreement_percentages):.2f}%")
-        print(f"Min percentage: {min(disagreement_percentages):.2f}%")
-        print(f"Max percentage: {max(disagreement_percentages):.2f}%")
+    if agreement['files']:
+        print(f"Average percentage needing review per file: {agreement['review_percent_sum'] / agreement['files']:.2f}%")
+        print(f"Min percentage: {agreement['review_percent_min']:.2f}%")
+        print(f"Max percentage: {agreement['review_percent_max']:.2f}%")
         
-        # Calculate quartiles
-        disagreement_percentages.sort()
-        q1_idx = len(disagreement_percentages) // 4
-        q3_idx = q1_idx * 3
-        print(f"25th percentile: {disagreement_percentages[q1_idx]:.2f}%")
-        print(f"Median percentage: {disagreement_percentages[len(disagreement_percentages) // 2]:.2f}%")
-        print(f"75th percentile: {disagreement_percentages[q3_idx]:.2f}%")
+        # Quantiles are estimated from the review percentage histogram
+        print(f"25th percentile: {review_quantile(agreement, 0.25):.2f}%")
+        print(f"Median percentage: {review_quantile(agreement, 0.5):.2f}%")
+        print(f"75th percentile: {review_quantile(agreement, 0.75):.2f}%")
+    
+    print_agreement(agreement)
+
+def print_agreement(agreement):
+    print("\n=== Scorer Agreement ===")
+    print(f"Epochs compared: {agreement['epochs']} ({agreement['epochs_incomplete']} with missing scores left out)")
+    kappa = fleiss_kappa(agreement)
+    if kappa is None:
+        return
+    print(f"Fleiss' kappa: {kappa:.3f}")
+    for pair, (observed, pair_kappa) in pair_agreement(agreement).items():
+        print(f"{pair}: {observed * 100:.2f}% agreement, Cohen's kappa {pair_kappa:.3f}")
+    print("Agreement per stage:")
+    for stage, specific_agreement in stage_agreement(agreement).items():
+        print(f"  {stage}: {specific_agreement * 100:.2f}%")
 
 # Usage
-data_dir = 'data_all'  
-output_dir = 'output/staging_annotation'  
-require_full_agreement = False  # Set to True if you want to require all 3 scorers to agree
+if __name__ == "__main__":
+    data_dir = 'data_all'  
+    output_dir = 'output/staging_annotation'  
+    require_full_agreement = False  # Set to True if you want to require all 3 scorers to agree
+    jobs = 1  # Number of files to process in parallel
+    incremental = True  # Set to False to reprocess files whose inputs have not changed
+    collapse_runs = False  # Set to True to write runs of the same stage as one row (see utils/stage_runs.py to expand)
 
-results = process_all_files(data_dir, output_dir, require_full_agreement)
-print_results(results, require_full_agreement)
+    results = process_all_files(data_dir, output_dir, require_full_agreement, jobs, incremental, collapse_runs)
+    print_results(results, require_full_agreement)
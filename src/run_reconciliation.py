@@ -0,0 +1,97 @@
+import argparse
+import logging
+import os
+import sys
+
+from utils.phases import enable_phase_report
+from utils.progress import configure_logging
+
+# Reconciliation modules are imported by the subcommand that needs them, so e.g. flow never loads pandas
+
+def run_events(module, args):
+    if args.study:
+        os.makedirs(args.output_dir, exist_ok=True)
+        output_csv, error = module.process_study(args.study, args.output_dir, args.engine)
+        return 1 if error else 0
+    module.process_all_studies(args.data_path, args.output_dir, args.engine, args.jobs, not args.full)
+    return 0
+
+def run_flow(args):
+    from reconciliation import flow
+    return run_events(flow, args)
+
+def run_arousal(args):
+    from reconciliation import arousal
+    return run_events(arousal, args)
+
+def run_staging(args):
+    from reconciliation import staging
+    if args.study:
+        return 0 if staging.process_file(args.study, args.output_dir, args.require_full_agreement, args.collapse_runs) else 1
+    results = staging.process_all_files(args.data_path, args.output_dir, args.require_full_agreement, args.jobs, not args.full,
+                                        args.collapse_runs)
+    staging.print_results(results, args.require_full_agreement)
+    return 0
+
+def run_merged(args):
+    import study_runner
+    if args.study:
+        os.makedirs(args.output_dir, exist_ok=True)
+        output_csv, error = study_runner.run_study(args.study, args.output_dir, args.flow_engine, args.arousal_engine,
+                                                   args.require_full_agreement, args.collapse_runs)
+        return 1 if error else 0
+    study_runner.run_all_studies(args.data_path, args.output_dir, args.flow_engine, args.arousal_engine,
+                                 args.require_full_agreement, args.jobs, args.collapse_runs)
+    return 0
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="Reconcile sleep scoring from three scorers")
+    parser.add_argument('--verbose', action='store_true', help="Log per-study and per-file details")
+    parser.add_argument('--event-details', action='store_true', help="Log buffered per-event diagnostics")
+    parser.add_argument('--phase-report', metavar='PATH', help="Append wall time, CPU time and peak memory per phase of each study to this JSONL file")
+    parser.add_argument('--no-memory', action='store_true', help="Leave peak memory out of the phase report, which avoids the tracemalloc overhead")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    def add_common(subparser, output_dir, study_help):
+        subparser.add_argument('--data-path', default='data_all', help="Folder with one subfolder per study")
+        subparser.add_argument('--output-dir', default=output_dir)
+        subparser.add_argument('--jobs', type=int, default=1, help="Number of studies to process in parallel")
+        subparser.add_argument('--study', help=study_help)
+
+    flow_parser = subparsers.add_parser('flow', help="Reconcile flow events")
+    add_common(flow_parser, 'output/flow_reconciliation_output', "Process only this study folder")
+    flow_parser.add_argument('--engine', choices=['bins', 'sweep'], default='sweep')
+    flow_parser.add_argument('--full', action='store_true', help="Reprocess every study, ignoring the manifest")
+    flow_parser.set_defaults(handler=run_flow)
+
+    arousal_parser = subparsers.add_parser('arousal', help="Reconcile arousal events")
+    add_common(arousal_parser, 'output/arousal_reconciliation_output', "Process only this study folder")
+    arousal_parser.add_argument('--engine', choices=['bins', 'bitmask'], default='bitmask')
+    arousal_parser.add_argument('--full', action='store_true', help="Reprocess every study, ignoring the manifest")
+    arousal_parser.set_defaults(handler=run_arousal)
+
+    staging_parser = subparsers.add_parser('staging', help="Reconcile sleep stages")
+    add_common(staging_parser, 'output/staging_annotation', "Process only this scorer CSV")
+    staging_parser.add_argument('--require-full-agreement', action='store_true', help="Require all 3 scorers to agree")
+    staging_parser.add_argument('--full', action='store_true', help="Reprocess every file, ignoring the manifest")
+    staging_parser.add_argument('--collapse-runs', action='store_true', help="Write runs of the same stage as one row; review epochs stay separate")
+    staging_parser.set_defaults(handler=run_staging)
+
+    merged_parser = subparsers.add_parser('merged', help="Run all reconciliations in one pass per study and write the merged annotation")
+    add_common(merged_parser, 'output/merged', "Process only this study folder")
+    merged_parser.add_argument('--flow-engine', choices=['bins', 'sweep'], default='sweep')
+    merged_parser.add_argument('--arousal-engine', choices=['bins', 'bitmask'], default='bitmask')
+    merged_parser.add_argument('--require-full-agreement', action='store_true', help="Require all 3 scorers to agree")
+    merged_parser.add_argument('--collapse-runs', action='store_true', help="Merge runs of the same stage into one row; review epochs stay separate")
+    merged_parser.set_defaults(handler=run_merged)
+
+    return parser
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    configure_logging(logging.DEBUG if args.verbose else logging.INFO, args.event_details)
+    enable_phase_report(args.phase_report, memory=not args.no_memory)
+    return args.handler(args)
+
+if __name__ == "__main__":
+    sys.exit(main())
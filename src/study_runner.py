@@ -0,0 +1,141 @@
+import os
+import time
+from collections import Counter
+import pandas as pd
+
+from reconciliation import arousal, flow, staging
+from reconciliation.common import format_event_rows, read_scorer_files
+from utils.add_stage_numbers import number_descriptions
+from utils.batch import append_error_log, map_in_pool
+from utils.combine_events import sort_events
+from utils.merge_staging_events import merge_staging_frames, read_markers_start_time
+from utils.phases import end_phase, study_phases
+from utils.stage_runs import collapse_stage_runs
+from utils.progress import configure_logging, format_counters, get_logger
+
+COLUMNS = ['Onset', 'Duration', 'Description']
+
+logger = get_logger('runner')
+
+def read_study(study_path):
+    """Read all inputs of a study in one pass: flow and arousal events per scorer,
+    the markers start time and the staging CSV named after the study"""
+    study_name = os.path.basename(study_path)
+    flow_files = read_scorer_files(study_path, 'Flow Events.txt', flow.SCORERS)
+    arousal_files = read_scorer_files(study_path, 'Classification Arousals.txt', arousal.SCORERS)
+
+    # Markers are taken from ES, or from MS if ES has none
+    start_time = None
+    for scorer in ['ES', 'MS']:
+        markers_path = os.path.join(study_path, scorer, 'Markers.txt')
+        if os.path.exists(markers_path):
+            start_time = read_markers_start_time(markers_path)
+            break
+
+    staging_path = os.path.join(study_path, f"{study_name}.csv")
+    staging_df = staging.read_stage_scores(staging_path) if os.path.exists(staging_path) else None
+    return flow_files, arousal_files, start_time, staging_df
+
+def run_study(study_path, output_dir, flow_engine='bins', arousal_engine='bins', require_full_agreement=False, collapse_runs=False):
+    """Reconcile flow, arousal and staging for one study and write its merged annotation.
+
+    Does in memory what staging.py, flow.py, arousal.py and generate_final_output.py
+    do through intermediate files, producing the same {study}_merged.csv.
+    """
+    study_name = os.path.basename(study_path)
+    output_csv = os.path.join(output_dir, f"{study_name}_merged.csv")
+    error_log = os.path.join(output_dir, "error_log.txt")
+    counters = Counter()
+    begin = time.perf_counter()
+
+    with study_phases(study_name, 'merged') as record:
+        try:
+            flow_files, arousal_files, start_time, staging_df = read_study(study_path)
+            end_phase('read')
+            if staging_df is None:
+                raise ValueError(f"No staging file found for {study_name}")
+            if not start_time:
+                raise ValueError(f"Could not find start time for {study_name}")
+
+            # A modality that fails is left out of the merge, as its reconciliation file would be missing
+            events = []
+            for module, engine, scorer_files in [(flow, flow_engine, flow_files), (arousal, arousal_engine, arousal_files)]:
+                try:
+                    final_events, study_start_time = module.reconcile_study(study_path, output_dir, engine, scorer_files, counters)
+                except Exception as e:
+                    error_message = f"Error processing {study_name}: {str(e)}"
+                    logger.error(error_message)
+                    append_error_log(error_log, error_message)
+                    continue
+                events.extend(dict(zip(COLUMNS, row)) for row in format_event_rows(final_events, study_start_time))
+
+            if not events:
+                raise ValueError(f"No reconciled flow or arousal events for {study_name}")
+
+            # Durations are parsed back to floats, as when the combined events file is read
+            events_df = pd.DataFrame(sort_events(events), columns=COLUMNS).astype({'Duration': float})
+
+            annotations, _, _ = staging.generate_stage_annotations(staging_df, require_full_agreement)
+            if collapse_runs:
+                annotations = collapse_stage_runs(annotations)
+            staging_df = pd.DataFrame(annotations, columns=COLUMNS)
+            staging_df['Description'] = number_descriptions(staging_df['Description'])
+            end_phase('staging')
+
+            merged_df = merge_staging_frames(events_df, staging_df, start_time)
+            merged_df.to_csv(output_csv, sep=',', index=False)
+            end_phase('merge')
+            if record is not None:
+                record['counters'] = dict(counters)
+
+            logger.info("%s: %s (%.2fs)", study_name, format_counters(counters), time.perf_counter() - begin)
+            return output_csv, None
+        except Exception as e:
+            error_message = f"Error processing {study_name}: {str(e)}"
+            logger.error(error_message)
+            append_error_log(error_log, error_message)
+            if record is not None:
+                record['error'] = error_message
+            return None, error_message
+
+def run_all_studies(data_path, output_dir, flow_engine='bins', arousal_engine='bins', require_full_agreement=False, jobs=1,
+                    collapse_runs=False):
+    os.makedirs(output_dir, exist_ok=True)
+
+    processed_files = []
+    failed_studies = []
+
+    studies = [study for study in sorted(os.listdir(data_path)) if os.path.isdir(os.path.join(data_path, study))]
+    study_paths = [os.path.join(data_path, study) for study in studies]
+    results = map_in_pool(run_study, study_paths, jobs, output_dir=output_dir, flow_engine=flow_engine,
+                          arousal_engine=arousal_engine, require_full_agreement=require_full_agreement, collapse_runs=collapse_runs)
+
+    for study, (output_csv, error) in zip(studies, results):
+        if output_csv:
+            processed_files.append(output_csv)
+        if error:
+            failed_studies.append((study, error))
+
+    # Log summary
+    logger.info("Processing Summary:")
+    logger.info("Successfully processed: %d studies", len(processed_files))
+    logger.info("Failed: %d studies", len(failed_studies))
+    if failed_studies:
+        logger.info("Failed studies:")
+        for study, error in failed_studies:
+            logger.info("- %s: %s", study, error)
+    logger.info("Merged files created in: %s", output_dir)
+
+    return processed_files, failed_studies
+
+if __name__ == "__main__":
+    configure_logging()
+    data_path = 'data_all'
+    output_dir = 'output/merged'
+    flow_engine = 'sweep'
+    arousal_engine = 'bitmask'
+    require_full_agreement = False  # Set to True if you want to require all 3 scorers to agree
+    jobs = 1  # Number of studies to process in parallel
+    collapse_runs = False  # Set to True to merge runs of the same stage into one row
+    processed_files, failed_studies = run_all_studies(data_path, output_dir, flow_engine, arousal_engine,
+                                                      require_full_agreement, jobs, collapse_runs)
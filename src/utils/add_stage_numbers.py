@@ -2,14 +2,23 @@ import pandas as pd
 import os
 
 def add_stage_numbers(input_file, output_file):
+    df = read_numbered_stages(input_file)
+    
+    # Save the modified data back to a CSV file
+    df.to_csv(output_file, sep='\t', index=False)
+
+def read_numbered_stages(input_file):
+    """Read a staging annotation file with its descriptions numbered, as add_stage_numbers writes it"""
     # Read the CSV file
     df = pd.read_csv(input_file, delimiter='\t')
     
     # Add ascending numbers to the Description column
-    df['Description'] = [f"{i+1}. {desc}" for i, desc in enumerate(df['Description'])]
-    
-    # Save the modified data back to a CSV file
-    df.to_csv(output_file, sep='\t', index=False)
+    df['Description'] = number_descriptions(df['Description'])
+    return df
+
+def number_descriptions(descriptions):
+    """Prefix descriptions with ascending numbers starting at 1"""
+    return [f"{i+1}. {desc}" for i, desc in enumerate(descriptions)]
 
 if __name__ == "__main__":
     # Directory containing the staging annotation files
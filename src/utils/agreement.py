@@ -0,0 +1,120 @@
+from collections import Counter
+import numpy as np
+
+# Staging scorers in the order staging reads their columns, and the pairs compared
+SCORERS = ['ES', 'MS', 'LS']
+PAIRS = [('ES', 'MS'), ('ES', 'LS'), ('MS', 'LS')]
+
+# Per-file review percentages are counted in buckets of this many percent, so
+# quantiles take bounded memory however many files are added
+REVIEW_BUCKET_PERCENT = 0.1
+
+def new_agreement_stats():
+    """Empty agreement statistics. All values are counts or nested dicts of counts, so
+    statistics from separate workers combine with merge_agreement_stats and store as JSON."""
+    return {
+        'files': 0,
+        'epochs': 0,
+        'epochs_incomplete': 0,
+        # {'ES/MS': {es_stage: {ms_stage: epochs}}}
+        'pairs': {f"{a}/{b}": {} for a, b in PAIRS},
+        # Ratings per stage, and the agreeing rater pairs behind them, for Fleiss' kappa
+        'stage_ratings': {},
+        'stage_agreeing_pairs': {},
+        # Files per review percentage bucket, with the sum, min and max of the percentages
+        'review_buckets': {},
+        'review_percent_sum': 0.0,
+        'review_percent_min': None,
+        'review_percent_max': None,
+    }
+
+def add_file_agreement(stats, es_score, ms_score, ls_score, review_epochs):
+    """Add one file's epochs (arrays of per-scorer stages) to stats.
+
+    Epochs missing a score are counted in epochs_incomplete and left out of the
+    agreement measures. review_epochs is the number of epochs the file needs reviewed.
+    """
+    # pandas is imported here so pool workers and other importers of this module start quickly
+    import pandas as pd
+
+    total_epochs = len(es_score)
+    complete = ~(pd.isna(es_score) | pd.isna(ms_score) | pd.isna(ls_score))
+    scores = {scorer: np.asarray(values[complete]).astype(str) for scorer, values in zip(SCORERS, [es_score, ms_score, ls_score])}
+
+    file_stats = new_agreement_stats()
+    file_stats['files'] = 1
+    file_stats['epochs'] = int(complete.sum())
+    file_stats['epochs_incomplete'] = total_epochs - file_stats['epochs']
+
+    for a, b in PAIRS:
+        confusion = file_stats['pairs'][f"{a}/{b}"]
+        for (stage_a, stage_b), count in Counter(zip(scores[a], scores[b])).items():
+            confusion.setdefault(stage_a, {})[stage_b] = count
+
+    for stage in np.unique(np.concatenate(list(scores.values()))):
+        raters = sum((values == stage).astype(int) for values in scores.values())
+        file_stats['stage_ratings'][stage] = int(raters.sum())
+        file_stats['stage_agreeing_pairs'][stage] = int((raters * (raters - 1)).sum())
+
+    review_percent = review_epochs / total_epochs * 100 if total_epochs > 0 else 0
+    file_stats['review_buckets'][str(int(review_percent // REVIEW_BUCKET_PERCENT))] = 1
+    file_stats['review_percent_sum'] = review_percent
+    file_stats['review_percent_min'] = file_stats['review_percent_max'] = review_percent
+
+    return merge_agreement_stats(stats, file_stats)
+
+def merge_agreement_stats(stats, other):
+    """Add the statistics in other to stats, e.g. a worker's partial result, and return stats"""
+    for key, value in other.items():
+        if key in ('review_percent_min', 'review_percent_max'):
+            if value is not None:
+                pick = min if key == 'review_percent_min' else max
+                stats[key] = value if stats.get(key) is None else pick(stats[key], value)
+        elif isinstance(value, dict):
+            merge_agreement_stats(stats.setdefault(key, {}), value)
+        else:
+            stats[key] = stats.get(key, 0) + value
+    return stats
+
+def fleiss_kappa(stats):
+    """Fleiss' kappa of the three scorers over all complete epochs, or None without epochs"""
+    rater_pairs = stats['epochs'] * len(SCORERS) * (len(SCORERS) - 1)
+    if rater_pairs == 0:
+        return None
+    observed = sum(stats['stage_agreeing_pairs'].values()) / rater_pairs
+    ratings = stats['epochs'] * len(SCORERS)
+    expected = sum((count / ratings) ** 2 for count in stats['stage_ratings'].values())
+    return 1.0 if expected == 1 else (observed - expected) / (1 - expected)
+
+def stage_agreement(stats):
+    """Specific agreement per stage: how often another scorer gave an epoch the same stage
+    as a scorer who chose this one"""
+    return {stage: stats['stage_agreeing_pairs'].get(stage, 0) / (ratings * (len(SCORERS) - 1))
+            for stage, ratings in sorted(stats['stage_ratings'].items()) if ratings}
+
+def pair_agreement(stats):
+    """{'ES/MS': (observed agreement, Cohen's kappa)} per scorer pair"""
+    results = {}
+    for pair, confusion in stats['pairs'].items():
+        total = sum(sum(row.values()) for row in confusion.values())
+        if total == 0:
+            continue
+        observed = sum(row.get(stage, 0) for stage, row in confusion.items()) / total
+        columns = Counter()
+        for row in confusion.values():
+            columns.update(row)
+        expected = sum(sum(row.values()) * columns[stage] for stage, row in confusion.items()) / total ** 2
+        results[pair] = (observed, 1.0 if expected == 1 else (observed - expected) / (1 - expected))
+    return results
+
+def review_quantile(stats, q):
+    """Approximate q-quantile of the per-file review percentages, within REVIEW_BUCKET_PERCENT"""
+    if stats['files'] == 0:
+        return None
+    seen = 0
+    for bucket in sorted(stats['review_buckets'], key=int):
+        seen += stats['review_buckets'][bucket]
+        if seen >= q * stats['files']:
+            estimate = (int(bucket) + 0.5) * REVIEW_BUCKET_PERCENT
+            return min(max(estimate, stats['review_percent_min']), stats['review_percent_max'])
+    return stats['review_percent_max']
@@ -1,11 +1,22 @@
+import csv
+from datetime import datetime, time
+import io
 import pandas as pd
-import matplotlib.pyplot as plt
 from pathlib import Path
 import re
 from collections import Counter
 import numpy as np
-import seaborn as sns
-from datetime import datetime, timedelta
+import os
+import sys
+
+if __package__ in (None, ''):
+    # Running as a script: make the src directory importable
+    sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.discovery import build_output_index
+from utils.stage_runs import expand_stage_rows
+from utils.stage_vocabulary import count_stages, normalize_stages, standard_stage_name
+from utils.timecodes import MS_PER_SECOND, clock_on_or_after
 
 def analyze_final_annotations(filename):
     """Analyze final reconciled annotations with focus on stage analytics"""
@@ -40,18 +51,20 @@ def analyze_stages(stage_df):
     if stage_df.empty:
         return {}
     
+    # Stage rows may be collapsed runs of epochs; count every epoch
+    stage_df = expand_stage_rows(stage_df.copy())
+    
     # Extract stage names
-    stage_df = stage_df.copy()
     stage_df['stage'] = stage_df['Annotation'].str.extract(r'Stage: (.+)')
     
     # Standardize stage names
-    stage_df['stage'] = stage_df['stage'].apply(standardize_stage_name)
+    stage_df['stage'] = normalize_stages(stage_df['stage'])
     
     # Filter out artifacts
     stage_df = stage_df[~stage_df['stage'].isin(['Artifact'])]
     
     # Stage distribution
-    stage_counts = stage_df['stage'].value_counts()
+    stage_counts = count_stages(stage_df['stage'])
     
     # Calculate percentages
     total_epochs = len(stage_df)
@@ -71,11 +84,12 @@ def load_merged_data(filename):
         
         # Filter for stage annotations
         stage_df = df[df['Description'].str.contains('Stage:', na=False)]
-        stage_df = stage_df.copy()
+        # Staging may write runs of epochs as one row; split them so each row is an epoch
+        stage_df = expand_stage_rows(stage_df.copy())
         stage_df['stage'] = stage_df['Description'].str.extract(r'Stage: (.+)')
         
         # Standardize stage names
-        stage_df['stage'] = stage_df['stage'].apply(standardize_stage_name)
+        stage_df['stage'] = normalize_stages(stage_df['stage'])
         
         # Filter out artifacts
         stage_df = stage_df[~stage_df['stage'].isin(['Artifact'])]
@@ -90,75 +104,75 @@ def parse_ai_timestamp(time_str, date_from_final):
     try:
         # Parse time (format: HH:MM:SS,mmm)
         time_part = time_str.split(',')[0]  # Remove milliseconds
-        time_obj = datetime.strptime(time_part, '%H:%M:%S').time()
-        
-        # Combine with date from final data
-        full_datetime = datetime.combine(date_from_final.date(), time_obj)
-        
-        # Handle day rollover (if time goes past midnight)
-        if full_datetime < date_from_final:
-            full_datetime += timedelta(days=1)
-            
-        return full_datetime
+
+        # Combine with date from final data, handling day rollover (if time goes past midnight)
+        return clock_on_or_after(time_part, date_from_final)
     except:
         return None
 
+def clocks_to_ms(clocks):
+    """clock_to_ms for an array of clock times at once, reading 'HH:MM:SS' up to any ',mmm'
+    (milliseconds are not read). Clock times in other forms give -1; decode those with clock_to_ms."""
+    chars = np.asarray(clocks, dtype='U9').view(np.uint32).reshape(-1, 9).astype(np.int64)
+    digits = chars[:, [0, 1, 3, 4, 6, 7]] - ord('0')
+    hours, minutes, seconds = digits[:, 0] * 10 + digits[:, 1], digits[:, 2] * 10 + digits[:, 3], digits[:, 4] * 10 + digits[:, 5]
+    # Strings shorter than 9 characters are padded with zeros
+    plain = (((digits >= 0) & (digits <= 9)).all(axis=1) & (chars[:, 2] == ord(':')) & (chars[:, 5] == ord(':'))
+             & ((chars[:, 8] == ord(',')) | (chars[:, 8] == 0)) & (hours <= 23) & (minutes <= 59) & (seconds <= 59))
+    return np.where(plain, ((hours * 60 + minutes) * 60 + seconds) * MS_PER_SECOND, -1)
+
+def clock_ms_on_or_after(clock_ms, reference):
+    """clock_on_or_after for an array of clock times in milliseconds since midnight, as
+    datetime64[ns] values with NaT where clock_ms is -1"""
+    full_datetimes = np.datetime64(datetime.combine(reference.date(), time.min), 'ns') + clock_ms.astype('timedelta64[ms]')
+    full_datetimes = np.where(full_datetimes < np.datetime64(reference, 'ns'), full_datetimes + np.timedelta64(1, 'D'), full_datetimes)
+    return np.where(clock_ms >= 0, full_datetimes, np.datetime64('NaT', 'ns'))
+
+def parse_ai_timestamps(time_strs, date_from_final):
+    """parse_ai_timestamp for a Series of AI scored timestamps at once, with NaT where it gives None"""
+    # The usual HH:MM:SS,mmm timestamps are decoded in one pass, dropping milliseconds like parse_ai_timestamp
+    clock_ms = clocks_to_ms(time_strs)
+    parsed = pd.Series(clock_ms_on_or_after(clock_ms, date_from_final), index=time_strs.index)
+    
+    # Any other form is parsed one by one
+    unread = clock_ms < 0
+    if unread.any():
+        parsed[unread] = pd.to_datetime([parse_ai_timestamp(time_str, date_from_final) for time_str in time_strs[unread]])
+    return parsed
+
 def load_ai_scored_data(filename, final_start_time=None):
     """Load and parse AI scored data with timestamp alignment"""
     try:
         with open(filename, 'r') as f:
-            lines = f.readlines()
+            text = f.read()
         
-        # Find start of data (after header)
+        # Find start of data (after header): skip the Rate line and empty line
         data_start = 0
-        for i, line in enumerate(lines):
-            if 'Rate:' in line:
-                data_start = i + 2  # Skip the Rate line and empty line
-                break
-        
-        # Parse data
-        data = []
-        for line in lines[data_start:]:
-            line = line.strip()
-            if not line:
-                continue
-                
-            parts = line.split(';')
-            if len(parts) >= 2:
-                time_str = parts[0].strip()
-                stage = parts[1].strip()
-                
-                # Parse timestamp if final_start_time is provided
-                parsed_time = None
-                if final_start_time:
-                    parsed_time = parse_ai_timestamp(time_str, final_start_time)
-                
-                data.append({
-                    'time_str': time_str, 
-                    'stage': stage,
-                    'parsed_time': parsed_time
-                })
-        
-        df = pd.DataFrame(data)
+        rate = text.find('Rate:')
+        if rate >= 0:
+            data_start = rate
+            for _ in range(2):
+                data_start = text.find('\n', data_start) + 1 or len(text)
+        
+        # Drop lines without a separator (including blank ones), then read the 'time; stage' block in one go
+        data = re.sub(r'(?m)^[^;\n]*(?:\n|$)', '', text[data_start:])
+        df = pd.read_csv(io.StringIO(data), sep=';', header=None, names=['time_str', 'stage'], usecols=[0, 1],
+                         index_col=False, dtype=str, keep_default_na=False, quoting=csv.QUOTE_NONE)
+        if df.empty:
+            raise ValueError("no scored epochs found")
+        df['time_str'] = df['time_str'].str.strip()
+        df['stage'] = df['stage'].str.strip()
+        
+        # Parse timestamps if final_start_time is provided, rolling over past midnight
+        df['parsed_time'] = None
+        if final_start_time:
+            df['parsed_time'] = parse_ai_timestamps(df['time_str'], final_start_time)
         
         # Map German stage names to English with consistent formatting
-        stage_mapping = {
-            'Wach': 'Wake',
-            'Stadium 1': 'N1', 
-            'Stadium 2': 'N2',
-            'Stadium 3': 'N3',
-            'Rem': 'REM',
-            'REM': 'REM',  # Handle case where it's already in English
-            'Wake': 'Wake',
-            'N1': 'N1',
-            'N2': 'N2', 
-            'N3': 'N3'
-        }
-        
-        df['stage_mapped'] = df['stage'].map(stage_mapping).fillna(df['stage'])
+        df['stage_mapped'] = normalize_stages(df['stage'])
         
         # Filter out artifacts
-        df = df[~df['stage_mapped'].isin(['Artefakt', 'Artifact', 'A'])]
+        df = df[~df['stage_mapped'].isin(['Artifact'])]
         
         return df
     except Exception as e:
@@ -167,39 +181,7 @@ def load_ai_scored_data(filename, final_start_time=None):
 
 def standardize_stage_name(stage):
     """Standardize stage names to consistent format"""
-    if pd.isna(stage):
-        return stage
-    
-    stage_str = str(stage).strip()
-    
-    # Standardize common variations
-    standardization_map = {
-        'rem': 'REM',
-        'Rem': 'REM', 
-        'REM': 'REM',
-        'wake': 'Wake',
-        'Wake': 'Wake',
-        'WAKE': 'Wake',
-        'n1': 'N1',
-        'N1': 'N1',
-        'stage 1': 'N1',
-        'Stage 1': 'N1',
-        'n2': 'N2',
-        'N2': 'N2', 
-        'stage 2': 'N2',
-        'Stage 2': 'N2',
-        'n3': 'N3',
-        'N3': 'N3',
-        'stage 3': 'N3',
-        'Stage 3': 'N3',
-        'artifact': 'Artifact',
-        'Artifact': 'Artifact',
-        'artefakt': 'Artifact',
-        'Artefakt': 'Artifact',
-        'A': 'Artifact'
-    }
-    
-    return standardization_map.get(stage_str, stage_str)
+    return standard_stage_name(stage)
 
 def align_and_compare_ai_final(final_df, ai_df):
     """Align AI scored data with final reconciled data and compare stages"""
@@ -207,16 +189,16 @@ def align_and_compare_ai_final(final_df, ai_df):
         return {}
     
     # Get stage data from final reconciled
-    final_stage_df = final_df[final_df['Annotation'].str.contains('Stage:', na=False)].copy()
+    final_stage_df = expand_stage_rows(final_df[final_df['Annotation'].str.contains('Stage:', na=False)].copy())
     final_stage_df['stage'] = final_stage_df['Annotation'].str.extract(r'Stage: (.+)')[0]
     
     # Standardize stage names in final data
-    final_stage_df['stage'] = final_stage_df['stage'].apply(standardize_stage_name)
+    final_stage_df['stage'] = normalize_stages(final_stage_df['stage'])
     final_stage_df = final_stage_df[~final_stage_df['stage'].isin(['Artifact'])]
     
     # Standardize stage names in AI data
     ai_df = ai_df.copy()
-    ai_df['stage_mapped'] = ai_df['stage_mapped'].apply(standardize_stage_name)
+    ai_df['stage_mapped'] = normalize_stages(ai_df['stage_mapped'])
     ai_df = ai_df[~ai_df['stage_mapped'].isin(['Artifact'])]
     
     # If AI data has parsed timestamps, try to align temporally
@@ -228,70 +210,66 @@ def align_and_compare_ai_final(final_df, ai_df):
 def compare_with_temporal_alignment(final_stage_df, ai_df):
     """Compare stages using temporal alignment"""
     try:
-        # Create 30-second epochs for both datasets
-        final_epochs = []
-        ai_epochs = []
-        
-        # Process final data - already in 30s epochs
-        for _, row in final_stage_df.iterrows():
-            final_epochs.append({
-                'timestamp': row['Onset'],
-                'stage': row['stage']
-            })
-        
-        # Process AI data - align to 30s epochs
-        ai_df_clean = ai_df[ai_df['parsed_time'].notna()].copy()
-        for _, row in ai_df_clean.iterrows():
-            ai_epochs.append({
-                'timestamp': row['parsed_time'],
-                'stage': row['stage_mapped']
-            })
-        
-        # Find overlapping time range
-        if not final_epochs or not ai_epochs:
+        # Final data is already in 30s epochs; epochs without a time are left out
+        final_df_clean = final_stage_df[final_stage_df['Onset'].notna()]
+        ai_df_clean = ai_df[ai_df['parsed_time'].notna()]
+        if final_df_clean.empty or ai_df_clean.empty:
             return {}
-            
-        final_start = min(e['timestamp'] for e in final_epochs)
-        final_end = max(e['timestamp'] for e in final_epochs)
-        ai_start = min(e['timestamp'] for e in ai_epochs)
-        ai_end = max(e['timestamp'] for e in ai_epochs)
-        
-        overlap_start = max(final_start, ai_start)
-        overlap_end = min(final_end, ai_end)
-        
+
+        # Times as int64 nanoseconds, so the alignment runs on numpy arrays
+        final_times = pd.to_datetime(final_df_clean['Onset']).to_numpy(dtype='datetime64[ns]').astype(np.int64)
+        ai_times = pd.to_datetime(ai_df_clean['parsed_time']).to_numpy(dtype='datetime64[ns]').astype(np.int64)
+
+        # Find overlapping time range
+        overlap_start = max(final_times.min(), ai_times.min())
+        overlap_end = min(final_times.max(), ai_times.max())
+
         if overlap_start >= overlap_end:
             return {'error': 'No temporal overlap found'}
-        
+
         # Align epochs within overlap period
-        aligned_comparisons = []
-        tolerance = timedelta(seconds=15)  # Allow 15s tolerance for alignment
-        
-        for final_epoch in final_epochs:
-            if overlap_start <= final_epoch['timestamp'] <= overlap_end:
-                # Find closest AI epoch
-                closest_ai = None
-                min_diff = timedelta.max
-                
-                for ai_epoch in ai_epochs:
-                    if overlap_start <= ai_epoch['timestamp'] <= overlap_end:
-                        diff = abs(final_epoch['timestamp'] - ai_epoch['timestamp'])
-                        if diff < min_diff and diff <= tolerance:
-                            min_diff = diff
-                            closest_ai = ai_epoch
-                
-                if closest_ai:
-                    aligned_comparisons.append({
-                        'final_stage': final_epoch['stage'],
-                        'ai_stage': closest_ai['stage'],
-                        'timestamp': final_epoch['timestamp']
-                    })
-        
-        return analyze_stage_differences(aligned_comparisons, method='temporal')
-        
+        tolerance = pd.Timedelta(seconds=15).value  # Allow 15s tolerance for alignment
+        final_in_overlap = np.flatnonzero((final_times >= overlap_start) & (final_times <= overlap_end))
+        ai_in_overlap = np.flatnonzero((ai_times >= overlap_start) & (ai_times <= overlap_end))
+        closest = nearest_within(final_times[final_in_overlap], ai_times[ai_in_overlap], tolerance)
+
+        aligned = closest >= 0
+        final_stages = final_df_clean['stage'].to_numpy()[final_in_overlap[aligned]]
+        ai_stages = ai_df_clean['stage_mapped'].to_numpy()[ai_in_overlap[closest[aligned]]]
+
+        return compare_stage_arrays(final_stages, ai_stages, method='temporal')
+
     except Exception as e:
         print(f"Error in temporal alignment: {e}")
         return compare_epoch_by_epoch(final_stage_df, ai_df)
 
+def nearest_within(times, reference_times, tolerance):
+    """For each of times, the index of the closest of reference_times at most tolerance away, or -1.
+
+    Sorts the reference times once and binary searches them, O((N + M) log M). Of
+    equally close reference times the one listed first is taken, as a scan in list
+    order keeping only strictly closer matches would.
+    """
+    if len(reference_times) == 0:
+        return np.full(len(times), -1)
+    order = np.argsort(reference_times, kind='stable')
+    sorted_times = reference_times[order]
+
+    # Closest time at or after each time, and the closest before it; searching 'left'
+    # for a time lands on the first of its duplicates, which a stable sort keeps in list order
+    position = np.searchsorted(sorted_times, times, side='left')
+    has_after = position < len(sorted_times)
+    has_before = position > 0
+    after = np.minimum(position, len(sorted_times) - 1)
+    before_time = sorted_times[np.maximum(position - 1, 0)]
+    before = np.searchsorted(sorted_times, before_time, side='left')
+
+    diff_after = np.where(has_after, sorted_times[after] - times, np.iinfo(np.int64).max)
+    diff_before = np.where(has_before, times - before_time, np.iinfo(np.int64).max)
+    take_before = (diff_before < diff_after) | ((diff_before == diff_after) & (order[before] < order[after]))
+    closest = np.where(take_before, order[before], order[after])
+    return np.where(np.minimum(diff_before, diff_after) <= tolerance, closest, -1)
+
 def compare_epoch_by_epoch(final_stage_df, ai_df):
     """Compare stages epoch by epoch when temporal alignment isn't possible"""
     final_stages = final_stage_df['stage'].values
@@ -301,59 +279,84 @@ def compare_epoch_by_epoch(final_stage_df, ai_df):
     if min_length == 0:
         return {}
     
-    comparisons = []
-    for i in range(min_length):
-        comparisons.append({
-            'final_stage': final_stages[i],
-            'ai_stage': ai_stages[i],
-            'epoch': i
-        })
-    
-    return analyze_stage_differences(comparisons, method='epoch')
+    return compare_stage_arrays(final_stages[:min_length], ai_stages[:min_length], method='epoch')
 
 def analyze_stage_differences(comparisons, method='temporal'):
     """Analyze differences between AI and final reconciled stages"""
     if not comparisons:
         return {}
     
-    total_comparisons = len(comparisons)
-    differences = []
-    agreement_count = 0
+    final_stages = [comp['final_stage'] for comp in comparisons]
+    ai_stages = [comp['ai_stage'] for comp in comparisons]
+    return compare_stage_arrays(final_stages, ai_stages, method)
+
+def stage_confusion_matrix(final_stages, ai_stages):
+    """Epochs per AI stage (rows) and final stage (columns), as a DataFrame.
+
+    Stages are coded as integers in order of first appearance and counted with one
+    bincount. Epochs missing a stage on either side are left out, as a missing stage
+    never agrees with anything. Matrices of several subjects add up with sum_confusion_matrices.
+    """
+    final_stages = np.asarray(final_stages, dtype=object)
+    ai_stages = np.asarray(ai_stages, dtype=object)
+    codes, stages = pd.factorize(np.concatenate([final_stages, ai_stages]))
+    n_stages = len(stages)
+    final_codes, ai_codes = codes[:len(final_stages)], codes[len(final_stages):]
+    # Missing stages are coded -1
+    scored = (final_codes >= 0) & (ai_codes >= 0)
+    counts = np.bincount(ai_codes[scored] * n_stages + final_codes[scored],
+                         minlength=n_stages * n_stages).reshape(n_stages, n_stages)
+    return pd.DataFrame(counts, index=list(stages), columns=list(stages))
+
+def sum_confusion_matrices(matrices):
+    """Add up confusion matrices of subjects that may have seen different stages"""
+    total = pd.concat(matrices).groupby(level=0, sort=False).sum()
+    return total.reindex(columns=total.index, fill_value=0).astype(int)
+
+def compare_stage_arrays(final_stages, ai_stages, method='temporal'):
+    """Agreement statistics of aligned AI and final stage arrays, derived from their confusion matrix"""
+    if len(final_stages) == 0:
+        return {}
     
-    for comp in comparisons:
-        final_stage = comp['final_stage']
-        ai_stage = comp['ai_stage']
-        
-        if final_stage == ai_stage:
-            agreement_count += 1
-        else:
-            differences.append({
-                'final_stage': final_stage,
-                'ai_stage': ai_stage,
-                'change_type': f"AI:{ai_stage} -> Final:{final_stage}"
-            })
+    confusion = stage_confusion_matrix(final_stages, ai_stages)
+    stages = list(confusion.index)
+    counts = confusion.to_numpy()
     
-    # Calculate statistics
+    # Calculate statistics; epochs missing a stage are not in the matrix and count as disagreements
+    total_comparisons = len(final_stages)
+    agreement_count = int(np.trace(counts))
+    disagreement_count = total_comparisons - agreement_count
     agreement_percentage = (agreement_count / total_comparisons * 100) if total_comparisons > 0 else 0
-    disagreement_count = len(differences)
     disagreement_percentage = (disagreement_count / total_comparisons * 100) if total_comparisons > 0 else 0
     
-    # Analyze disagreement patterns
-    ai_stage_errors = Counter([d['ai_stage'] for d in differences])
-    final_stage_corrections = Counter([d['final_stage'] for d in differences])
-    change_types = Counter([d['change_type'] for d in differences])
+    # Disagreement patterns, listed in order of first occurrence so that ties in most_common()
+    # come out as they did when counted epoch by epoch. Missing stages are not in the confusion
+    # matrix; as then, they are listed under nan, coded n_stages here.
+    n_stages = len(stages)
+    labels = stages + [np.nan]
+    ai_codes = pd.Index(stages).get_indexer(np.asarray(ai_stages, dtype=object))
+    final_codes = pd.Index(stages).get_indexer(np.asarray(final_stages, dtype=object))
+    ai_codes[ai_codes < 0] = n_stages
+    final_codes[final_codes < 0] = n_stages
+    differs = (ai_codes != final_codes) | (ai_codes == n_stages)
+    ai_errors, final_corrections = ai_codes[differs], final_codes[differs]
+    ai_error_counts = np.bincount(ai_errors, minlength=len(labels))
+    final_correction_counts = np.bincount(final_corrections, minlength=len(labels))
+    changes = ai_errors * len(labels) + final_corrections
+    change_counts = np.bincount(changes, minlength=len(labels) * len(labels))
+    
+    ai_stage_errors = {labels[code]: int(ai_error_counts[code]) for code in pd.unique(ai_errors)}
+    final_stage_corrections = {labels[code]: int(final_correction_counts[code]) for code in pd.unique(final_corrections)}
+    change_types = {f"AI:{labels[code // len(labels)]} -> Final:{labels[code % len(labels)]}": int(change_counts[code])
+                    for code in pd.unique(changes)}
     
     # Stage-specific disagreement rates
-    all_stages = set()
-    for comp in comparisons:
-        all_stages.add(comp['final_stage'])
-        all_stages.add(comp['ai_stage'])
-    
+    ai_totals = np.bincount(ai_codes, minlength=len(labels))
     stage_disagreements = {}
-    for stage in all_stages:
-        stage_total = sum(1 for c in comparisons if c['ai_stage'] == stage)
-        stage_errors = sum(1 for d in differences if d['ai_stage'] == stage)
+    for code, stage in enumerate(stages):
+        stage_total = int(ai_totals[code])
         if stage_total > 0:
+            stage_errors = int(ai_error_counts[code])
             stage_disagreements[stage] = {
                 'total_ai_scored': stage_total,
                 'disagreements': stage_errors,
@@ -366,10 +369,11 @@ def analyze_stage_differences(comparisons, method='temporal'):
         'disagreement_count': disagreement_count,
         'agreement_percentage': agreement_percentage,
         'disagreement_percentage': disagreement_percentage,
-        'ai_stage_errors': dict(ai_stage_errors),
-        'final_stage_corrections': dict(final_stage_corrections),
-        'change_types': dict(change_types),
+        'ai_stage_errors': ai_stage_errors,
+        'final_stage_corrections': final_stage_corrections,
+        'change_types': change_types,
         'stage_disagreements': stage_disagreements,
+        'confusion_matrix': confusion,
         'alignment_method': method
     }
 
@@ -388,12 +392,12 @@ def compare_stage_distributions(final_analysis, merged_df, ai_df, subject_id):
     
     # Merged data
     if merged_df is not None and not merged_df.empty:
-        merged_counts = merged_df['stage'].value_counts()
+        merged_counts = count_stages(merged_df['stage'])
         comparison['merged'] = merged_counts.to_dict()
     
     # AI scored data
     if ai_df is not None and not ai_df.empty:
-        ai_counts = ai_df['stage_mapped'].value_counts()
+        ai_counts = count_stages(ai_df['stage_mapped'])
         comparison['ai_scored'] = ai_counts.to_dict()
     
     return comparison
@@ -404,44 +408,36 @@ def analyze_reconciliation_changes(merged_df, final_df):
         return {}
     
     # Get stage data from both datasets
-    merged_stages = merged_df['stage'].values
-    final_stage_df = final_df[final_df['Annotation'].str.contains('Stage:', na=False)]
-    final_stages = final_stage_df['Annotation'].str.extract(r'Stage: (.+)')[0].values
-    
-    # Standardize stage names
-    final_stages_standardized = [standardize_stage_name(stage) for stage in final_stages]
+    merged_stages = np.asarray(merged_df['stage'], dtype=object)
+    # Both are compared epoch by epoch, so runs of epochs in one row are split first
+    final_stage_df = expand_stage_rows(final_df[final_df['Annotation'].str.contains('Stage:', na=False)])
+    final_stages = normalize_stages(final_stage_df['Annotation'].str.extract(r'Stage: (.+)')[0])
     
     # Filter out artifacts
-    final_stages_clean = []
-    for stage in final_stages_standardized:
-        if stage not in ['Artifact']:
-            final_stages_clean.append(stage)
-    final_stages = np.array(final_stages_clean)
+    final_stages = np.asarray(final_stages[final_stages != 'Artifact'], dtype=object)
     
     # Find changes
-    changes = []
     min_length = min(len(merged_stages), len(final_stages))
-    
-    for i in range(min_length):
-        if merged_stages[i] != final_stages[i]:
-            changes.append({
-                'epoch': i,
-                'merged_stage': merged_stages[i],
-                'final_stage': final_stages[i]
-            })
+    merged_stages = merged_stages[:min_length]
+    final_stages = final_stages[:min_length]
+    changed = merged_stages != final_stages
+    merged_changed = merged_stages[changed]
+    final_changed = final_stages[changed]
+    total_changes = int(changed.sum())
     
     change_summary = {
-        'total_changes': len(changes),
-        'change_percentage': (len(changes) / min_length * 100) if min_length > 0 else 0,
-        'change_types': Counter([f"{c['merged_stage']} -> {c['final_stage']}" for c in changes]),
-        'changes_by_merged_stage': Counter([c['merged_stage'] for c in changes]),
-        'changes_by_final_stage': Counter([c['final_stage'] for c in changes])
+        'total_changes': total_changes,
+        'change_percentage': (total_changes / min_length * 100) if min_length > 0 else 0,
+        'change_types': Counter([f"{merged} -> {final}" for merged, final in zip(merged_changed, final_changed)]),
+        'changes_by_merged_stage': Counter(merged_changed),
+        'changes_by_final_stage': Counter(final_changed)
     }
     
     return change_summary
 
 def plot_reconciliation_analysis(comparisons, output_dir='plots'):
     """Create plots focused on reconciliation impact"""
+    import matplotlib.pyplot as plt  # Imported lazily so the analysis helpers load without matplotlib
     Path(output_dir).mkdir(exist_ok=True)
     
     # Collect all unique stages (excluding artifacts)
@@ -568,6 +564,7 @@ def plot_reconciliation_analysis(comparisons, output_dir='plots'):
 
 def plot_stage_comparison(comparisons, output_dir='plots'):
     """Create simplified stage distribution comparison"""
+    import matplotlib.pyplot as plt  # Imported lazily so the analysis helpers load without matplotlib
     Path(output_dir).mkdir(exist_ok=True)
     
     # Collect all unique stages (excluding artifacts)
@@ -624,7 +621,7 @@ def plot_stage_comparison(comparisons, output_dir='plots'):
 def analyze_all_files():
     """Analyze all available files and create comprehensive comparison"""
     final_dir = Path("data_reconciled/final")
-    merged_dir = Path("output/merged")
+    output_index = build_output_index("output")
     ai_scored_dir = Path("data_AI_scored")
     
     final_files = list(final_dir.glob("*.txt"))
@@ -645,8 +642,8 @@ def analyze_all_files():
             continue
             
         # Find corresponding merged file
-        merged_file = merged_dir / f"{subject_id}_merged.csv"
-        merged_df = load_merged_data(str(merged_file)) if merged_file.exists() else None
+        merged_file = output_index.get(subject_id, {}).get('merged')
+        merged_df = load_merged_data(merged_file) if merged_file else None
         
         # Find corresponding AI scored file
         ai_file = ai_scored_dir / f"{subject_id}.txt"
@@ -740,6 +737,7 @@ if __name__ == "__main__":
         total_ai_agreements = []
         ai_disagreement_types = Counter()
         ai_stage_errors = Counter()
+        ai_confusion_matrices = []
         
         for comp in comparisons:
             # Reconciliation analysis
@@ -762,6 +760,7 @@ if __name__ == "__main__":
                     total_ai_agreements.append(ai_comp['agreement_percentage'])
                     ai_disagreement_types.update(ai_comp.get('change_types', {}))
                     ai_stage_errors.update(ai_comp.get('ai_stage_errors', {}))
+                    ai_confusion_matrices.append(ai_comp['confusion_matrix'])
         
         print(f"Subjects analyzed: {total_subjects}")
         print(f"Subjects with reconciliation changes: {subjects_with_changes} ({subjects_with_changes/total_subjects*100:.1f}%)")
@@ -796,6 +795,9 @@ if __name__ == "__main__":
                 print(f"\nMost common AI vs Final disagreements:")
                 for disagreement, count in ai_disagreement_types.most_common(5):
                     print(f"  {disagreement}: {count} cases")
+            
+            print("\nAI (rows) vs Final (columns) epochs, all subjects:")
+            print(sum_confusion_matrices(ai_confusion_matrices).to_string())
         
         print(f"\nDetailed analysis plots saved in 'plots/' directory")
         print("- stage_comparison.png: Final vs Merged vs AI scored distributions")
@@ -0,0 +1,46 @@
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from functools import partial
+
+from utils import phases, progress
+
+# Set in pool workers so appends to a shared error log or report do not interleave
+error_log_lock = None
+
+def init_worker(lock, logging_settings, report_settings=None):
+    global error_log_lock
+    error_log_lock = lock
+    # Workers started without fork do not inherit the parent's logging or report setup
+    if logging_settings:
+        progress.configure_logging(**logging_settings)
+    if report_settings:
+        phases.enable_phase_report(**report_settings)
+
+def append_line(file_path, line):
+    """Append a line to a file shared by all workers of a batch"""
+    if error_log_lock is None:
+        with open(file_path, 'a') as f:
+            f.write(line)
+    else:
+        with error_log_lock:
+            with open(file_path, 'a') as f:
+                f.write(line)
+
+def append_error_log(error_log, message):
+    """Append a timestamped line to an error log shared by all workers of a batch"""
+    append_line(error_log, f"{datetime.now()}: {message}\n")
+
+def map_in_pool(function, items, jobs=1, **kwargs):
+    """Call function(item, **kwargs) for every item, in a process pool when jobs > 1.
+
+    Results are returned in the order of items regardless of which worker
+    finishes first, so batch summaries do not depend on scheduling.
+    """
+    task = partial(function, **kwargs)
+    if jobs is None or jobs <= 1 or len(items) <= 1:
+        return [task(item) for item in items]
+
+    lock = multiprocessing.Lock()
+    with ProcessPoolExecutor(max_workers=min(jobs, len(items)), initializer=init_worker, initargs=(lock, progress.logging_settings, phases.report_settings)) as executor:
+        return list(executor.map(task, items))
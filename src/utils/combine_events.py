@@ -1,10 +1,29 @@
 import csv
+import heapq
 import os
+import sys
 from datetime import datetime
 
+if __package__ in (None, ''):
+    # Running as a script: make the src directory importable
+    sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.discovery import build_output_index
+
+# Reconciliation files are time-ordered except within an event, where a single-scorer
+# period before the agreed event is written after it, so a small buffer restores the order
+REORDER_WINDOW = 16
+
+class EventsOutOfOrder(ValueError):
+    """An event is further out of order than the merge buffer of ordered_events can fix"""
+
 def parse_datetime(dt_string):
     return datetime.strptime(dt_string, "%Y-%m-%dT%H:%M:%S.%f")
 
+def onset_key(event):
+    # fromisoformat reads the same timestamps as parse_datetime, several times faster
+    return datetime.fromisoformat(event['Onset'])
+
 def read_csv(filename):
     with open(filename, 'r') as f:
         reader = csv.DictReader(f, delimiter='\t')
@@ -24,12 +43,98 @@ def combine_and_sort_events(files):
                     stage_counter += 1
         all_events.extend(events)
     
+    return sort_events(all_events)
+
+def sort_events(all_events):
+    """Sort Onset/Duration/Description event dicts by onset time"""
     # Check if all events have the 'Onset' key
     if not all('Onset' in event for event in all_events):
         print(f"Skipping file(s) due to missing 'Onset' key in events.")
         return []
 
-    return sorted(all_events, key=lambda x: parse_datetime(x['Onset']))
+    return sorted(all_events, key=onset_key)
+
+def read_fieldnames(filename):
+    with open(filename, 'r') as f:
+        return csv.DictReader(f, delimiter='\t').fieldnames
+
+def iter_events(filename, first_stage_number=None):
+    """Yield a file's event dicts, numbering staging descriptions from first_stage_number if given"""
+    stage_counter = first_stage_number
+    with open(filename, 'r') as f:
+        for event in csv.DictReader(f, delimiter='\t'):
+            if stage_counter is not None and 'Stage:' in event['Description']:
+                event['Description'] = f"{stage_counter}. {event['Description']}"
+                stage_counter += 1
+            yield event
+
+def count_stages(filename):
+    return sum(1 for event in iter_events(filename) if 'Stage:' in event['Description'])
+
+def ordered_events(events, window=REORDER_WINDOW):
+    """Yield (onset, position, event) for nearly time-ordered events in onset order, buffering
+    at most window events. Raises EventsOutOfOrder for an event further out of order than that."""
+    buffer = []
+    last_onset = None
+    for position, event in enumerate(events):
+        heapq.heappush(buffer, (onset_key(event), position, event))
+        if len(buffer) > window:
+            item = heapq.heappop(buffer)
+            if last_onset is not None and item[0] < last_onset:
+                raise EventsOutOfOrder(f"Event at {item[2]['Onset']} is more than {window} rows out of order")
+            last_onset = item[0]
+            yield item
+    while buffer:
+        item = heapq.heappop(buffer)
+        if last_onset is not None and item[0] < last_onset:
+            raise EventsOutOfOrder(f"Event at {item[2]['Onset']} is more than {window} rows out of order")
+        last_onset = item[0]
+        yield item
+
+def merge_events(files):
+    """Yield the events of all files in onset order, as combine_and_sort_events returns them,
+    holding only a few rows per file in memory"""
+    # Stage numbers continue from file to file, so count the stages of earlier staging files first
+    stage_numbers = {}
+    stage_counter = 1
+    for file in files:
+        if 'staging' in file.lower():
+            stage_numbers[file] = stage_counter
+            stage_counter += count_stages(file)
+
+    # Ties keep file order, as in a stable sort of the files' events one after another
+    streams = [ordered_events(iter_events(file, stage_numbers.get(file))) for file in files]
+    for _, _, event in heapq.merge(*streams, key=lambda item: item[0]):
+        yield event
+
+def has_onset_column(files):
+    # Check if all events have the 'Onset' key
+    if not all('Onset' in (read_fieldnames(file) or ['Onset']) for file in files):
+        print("Skipping file(s) due to missing 'Onset' key in events.")
+        return False
+    return True
+
+def combined_events(files):
+    """Return the events of all files in onset order, as combine_events_to_csv writes them"""
+    if not has_onset_column(files):
+        return []
+    try:
+        return list(merge_events(files))
+    except EventsOutOfOrder:
+        # A file too far out of order for the merge buffer; sort everything in memory instead
+        return combine_and_sort_events(files)
+
+def combine_events_to_csv(files, output_file):
+    """Write the events of all files to output_file in onset order, merging the files as they are read"""
+    if not has_onset_column(files):
+        write_combined_csv([], output_file)
+        return
+
+    try:
+        write_combined_csv(merge_events(files), output_file)
+    except EventsOutOfOrder:
+        # A file too far out of order for the merge buffer; sort everything in memory instead
+        write_combined_csv(combine_and_sort_events(files), output_file)
 
 def write_combined_csv(events, output_file):
     fieldnames = ['Onset', 'Duration', 'Description']
@@ -41,39 +146,21 @@ def write_combined_csv(events, output_file):
 
 def process_all_files():
     base_dir = 'output'
-    folders = {
-        'flow': 'flow_reconciliation_output',
-        'event': 'arousal_reconciliation_output'
-    }
     
     # Create the combined folder if it doesn't exist
     combined_dir = os.path.join(base_dir, 'combined')
     os.makedirs(combined_dir, exist_ok=True)
     
-    # Get all unique subject IDs
-    subject_ids = set()
-    for folder in folders.values():
-        folder_path = os.path.join(base_dir, folder)
-        for filename in os.listdir(folder_path):
-            subject_id = filename.split('_')[0]
-            subject_ids.add(subject_id)
+    # Find each subject's flow and arousal files in one listing of the output folders
+    index = build_output_index(base_dir)
     
     # Process each subject
-    for subject_id in subject_ids:
-        input_files = []
-        for folder_name, folder_path in folders.items():
-            full_folder_path = os.path.join(base_dir, folder_path)
-            matching_files = [
-                os.path.join(full_folder_path, filename)
-                for filename in os.listdir(full_folder_path)
-                if filename.startswith(subject_id)
-            ]
-            input_files.extend(matching_files)
+    for subject_id, artifacts in index.items():
+        input_files = [artifacts[kind] for kind in ('flow', 'arousal') if kind in artifacts]
         
         if input_files:
             output_file = os.path.join(combined_dir, f'{subject_id}_combined_events.csv')
-            combined_events = combine_and_sort_events(input_files)
-            write_combined_csv(combined_events, output_file)
+            combine_events_to_csv(input_files, output_file)
             print(f"Combined events for {subject_id} have been written to {output_file}")
 
 if __name__ == "__main__":
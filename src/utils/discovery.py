@@ -0,0 +1,39 @@
+import os
+
+# Output artifacts per subject: the folder under output/ and the suffix after the subject ID
+ARTIFACTS = {
+    'flow': ('flow_reconciliation_output', '_flow_reconciliation.csv'),
+    'arousal': ('arousal_reconciliation_output', '_arousal_reconciliation_no_label.csv'),
+    'staging': ('staging_annotation', '_stage_annotations.csv'),
+    'staging_numbered': ('staging_annotation', '_stage_annotations_numbered.csv'),
+    'combined': ('combined', '_combined_events.csv'),
+    'merged': ('merged', '_merged.csv'),
+}
+
+def build_output_index(base_dir='output'):
+    """Map each subject ID to its output files, e.g. {'AWV001': {'flow': path, 'merged': path}}.
+
+    Each output folder is listed once. Subject IDs are what precedes an artifact's
+    suffix, so IDs that are prefixes of each other are kept apart and files that are
+    not artifacts (e.g. error_log.txt) are left out. Subjects are in sorted order.
+    """
+    suffixes = {}
+    for kind, (folder, suffix) in ARTIFACTS.items():
+        suffixes.setdefault(folder, []).append((kind, suffix))
+
+    index = {}
+    for folder, kinds in suffixes.items():
+        folder_path = os.path.join(base_dir, folder)
+        if not os.path.isdir(folder_path):
+            continue
+        with os.scandir(folder_path) as entries:
+            for entry in entries:
+                for kind, suffix in kinds:
+                    if entry.name.endswith(suffix) and len(entry.name) > len(suffix) and entry.is_file():
+                        index.setdefault(entry.name[:-len(suffix)], {})[kind] = entry.path
+                        break
+    return dict(sorted(index.items()))
+
+def subjects_with(index, kind):
+    """Subject IDs in index that have the given artifact"""
+    return [subject_id for subject_id, artifacts in index.items() if kind in artifacts]
@@ -0,0 +1,84 @@
+import hashlib
+import json
+import os
+from utils.progress import get_logger
+
+logger = get_logger('manifest')
+
+# Bump when a change to the reconciliation logic or to the recorded summaries should
+# invalidate every recorded output. 2: staging summaries include agreement statistics
+MANIFEST_VERSION = 2
+
+def manifest_path(output_dir):
+    """The manifest sits next to its output directory, e.g. output/flow_reconciliation_output.manifest.json"""
+    return os.path.normpath(output_dir) + '.manifest.json'
+
+def load_manifest(output_dir):
+    """Return the recorded {output_name: fingerprint} entries, or {} if there is no usable manifest"""
+    path = manifest_path(output_dir)
+    if not os.path.exists(path):
+        return {}
+    try:
+        with open(path, 'r') as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        logger.warning("Ignoring unreadable manifest %s", path)
+        return {}
+    if manifest.get('version') != MANIFEST_VERSION:
+        return {}
+    return manifest.get('outputs', {})
+
+def save_manifest(output_dir, outputs):
+    path = manifest_path(output_dir)
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    # Write to a temporary file first so an interrupted run never leaves a truncated manifest
+    temp_path = path + '.tmp'
+    with open(temp_path, 'w') as f:
+        json.dump({'version': MANIFEST_VERSION, 'outputs': outputs}, f, indent=2, sort_keys=True)
+    os.replace(temp_path, path)
+
+def hash_file(file_path, previous=None):
+    """Return the sha256, size and mtime of a file.
+
+    The previous entry's hash is reused when size and mtime are unchanged, so
+    unchanged studies are not read again on every run.
+    """
+    stat = os.stat(file_path)
+    if previous and previous.get('size') == stat.st_size and previous.get('mtime_ns') == stat.st_mtime_ns:
+        return previous
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return {'sha256': digest.hexdigest(), 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+def fingerprint_inputs(outputs, output_path, input_paths, params):
+    """Fingerprint the inputs and parameters an output is built from. Missing inputs are recorded as None."""
+    previous = outputs.get(os.path.basename(output_path), {}).get('inputs', {})
+    inputs = {}
+    for input_path in input_paths:
+        inputs[input_path] = hash_file(input_path, previous.get(input_path)) if os.path.exists(input_path) else None
+    return {'inputs': inputs, 'params': params}
+
+def is_up_to_date(outputs, output_path, fingerprint):
+    """True if output_path exists and was built from the same input contents and parameters"""
+    recorded = outputs.get(os.path.basename(output_path))
+    if recorded is None or not os.path.exists(output_path):
+        return False
+    if recorded['params'] != fingerprint['params'] or recorded['inputs'].keys() != fingerprint['inputs'].keys():
+        return False
+    return all((recorded['inputs'][path] or {}).get('sha256') == (hashes or {}).get('sha256')
+               for path, hashes in fingerprint['inputs'].items())
+
+def record_output(outputs, output_path, fingerprint, summary=None):
+    """Record the fingerprint an output was built from, with an optional summary to report when it is skipped"""
+    entry = dict(fingerprint)
+    if summary is not None:
+        entry['summary'] = summary
+    outputs[os.path.basename(output_path)] = entry
+
+def recorded_summary(outputs, output_path):
+    return outputs.get(os.path.basename(output_path), {}).get('summary')
+
+def forget_output(outputs, output_path):
+    outputs.pop(os.path.basename(output_path), None)
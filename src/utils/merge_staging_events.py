@@ -1,11 +1,19 @@
+import numpy as np
 import pandas as pd
 from datetime import datetime, timedelta
+from functools import lru_cache
 import os
-import glob
+import sys
 
+if __package__ in (None, ''):
+    # Running as a script: make the src directory importable
+    sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
+from utils.discovery import build_output_index, subjects_with
+
+@lru_cache(maxsize=None)
 def parse_markers_file(awv_id):
-    """Extract start time from markers file"""
+    """Extract start time from markers file. Cached per study, as the markers do not change during a run"""
     markers_path = f"data_all/{awv_id}/ES/Markers.txt"
     
     if not os.path.exists(markers_path):
@@ -15,6 +23,10 @@ def parse_markers_file(awv_id):
             print(f"Markers file not found for {awv_id}. Skipping...")
             return None
     
+    return read_markers_start_time(markers_path)
+
+def read_markers_start_time(markers_path):
+    """Return the time of the '; Start' marker in a Markers.txt file, or None"""
     with open(markers_path, 'r') as f:
         for line in f:
             if '; Start' in line:
@@ -32,45 +44,62 @@ def combine_staging_and_events(awv_id):
     # Read the staging annotations
     staging_df = pd.read_csv(f'output/staging_annotation/{awv_id}_stage_annotations_numbered.csv', sep='\t')
     
+    write_merged_file(awv_id, events_df, staging_df)
+
+def events_frame(events):
+    """Event dicts (e.g. from combine_events) as a DataFrame typed like the combined events file read by pandas"""
+    events_df = pd.DataFrame(events, columns=['Onset', 'Duration', 'Description'])
+    events_df['Duration'] = pd.to_numeric(events_df['Duration'], errors='coerce')
+    return events_df
+
+def write_merged_file(awv_id, events_df, staging_df, output_path=None):
+    """Merge a subject's events and numbered staging annotations into output_path,
+    output/merged/{awv_id}_merged.csv by default"""
     # Get the start time from markers file
     start_time = parse_markers_file(awv_id)
     if not start_time:
         print(f"Could not find start time for {awv_id}")
         return
     
+    combined_df = merge_staging_frames(events_df, staging_df, start_time)
+    
+    # Save the result as a comma-delimited file
+    if output_path is None:
+        output_path = f'output/merged/{awv_id}_merged.csv'
+    os.makedirs(os.path.dirname(output_path), exist_ok=True)
+    combined_df.to_csv(output_path, sep=',', index=False)
+
+def merge_staging_frames(events_df, staging_df, start_time):
+    """Place staging epochs (onsets in seconds) at the markers start time and sort them in with the events"""
     # Convert start_time to datetime using the date from events file
     first_event = pd.to_datetime(events_df['Onset'].iloc[0])
-    base_date = first_event.date()
-    start_datetime = datetime.combine(base_date, start_time)
+    start_datetime = datetime.combine(first_event.date(), start_time)
     
-    # Convert staging seconds to timestamps
-    staging_df['Onset'] = staging_df['Onset'].apply(
-        lambda x: (start_datetime + timedelta(seconds=float(x))).strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3]
-    )
+    # Nights cross midnight: take the start on the day that puts it within 12 hours of the first event
+    if start_datetime - first_event > timedelta(hours=12):
+        start_datetime -= timedelta(days=1)
+    elif first_event - start_datetime > timedelta(hours=12):
+        start_datetime += timedelta(days=1)
     
+    # Convert staging seconds to timestamps, formatted to milliseconds like the event onsets
+    onsets = pd.Timestamp(start_datetime) + pd.to_timedelta(staging_df['Onset'].astype(float), unit='s')
+    staging_df['Onset'] = np.datetime_as_string(onsets.to_numpy().astype('datetime64[ms]'), unit='ms')
     
     # Combine the dataframes
     combined_df = pd.concat([events_df, staging_df])
     
-    # Sort by onset time
-    combined_df = combined_df.sort_values('Onset')
-    
-    # Save the result as a comma-delimited file
-    output_path = f'output/merged/{awv_id}_merged.csv'
-    os.makedirs(os.path.dirname(output_path), exist_ok=True)
-    combined_df.to_csv(output_path, sep=',', index=False)
+    # Sort by onset time, keeping events before stages with the same onset
+    combined_df = combined_df.sort_values('Onset', key=lambda onsets: pd.to_datetime(onsets, format='ISO8601'), kind='stable')
     
+    return combined_df
+
 def main():
-    # Find all combined event files
-    event_files = glob.glob('output/combined/*_combined_events.csv')
+    # Find all combined event files and their staging files in one listing of the output folders
+    index = build_output_index('output')
     
-    for event_file in event_files:
-        # Extract AWV ID from filename
-        awv_id = os.path.basename(event_file).split('_')[0]
-        
+    for awv_id in subjects_with(index, 'combined'):
         # Check if corresponding staging file exists
-        staging_file = f'output/staging_annotation/{awv_id}_stage_annotations_numbered.csv'
-        if os.path.exists(staging_file):
+        if 'staging_numbered' in index[awv_id]:
             print(f"Processing {awv_id}...")
             combine_staging_and_events(awv_id)
         else:
@@ -0,0 +1,98 @@
+import json
+import time
+import tracemalloc
+from contextlib import contextmanager
+from datetime import datetime
+
+# Wall time, CPU time and peak traced memory per phase of the study being recorded,
+# or None when not recording
+current_phases = None
+phase_started = None
+track_memory = False
+started_tracing = False
+
+# JSONL file that study_phases appends one record per study to, or None when disabled
+report_settings = None
+
+def start_phases(memory=False):
+    """Start recording phase timings for one study, with tracemalloc peaks if memory is set"""
+    global current_phases, phase_started, track_memory, started_tracing
+    track_memory = memory
+    started_tracing = memory and not tracemalloc.is_tracing()
+    if started_tracing:
+        tracemalloc.start()
+    if memory:
+        tracemalloc.reset_peak()
+    current_phases = {}
+    phase_started = (time.perf_counter(), time.process_time())
+
+def end_phase(name):
+    """Attribute the time since the previous end_phase (or start_phases) to the phase name.
+
+    Does nothing unless start_phases was called, so the calls can stay in the
+    reconciliation code at no cost.
+    """
+    global phase_started
+    if current_phases is None:
+        return
+    now = (time.perf_counter(), time.process_time())
+    phase = current_phases.setdefault(name, {'wall_seconds': 0.0, 'cpu_seconds': 0.0})
+    phase['wall_seconds'] += now[0] - phase_started[0]
+    phase['cpu_seconds'] += now[1] - phase_started[1]
+    if track_memory:
+        phase['peak_memory_bytes'] = max(phase.get('peak_memory_bytes', 0), tracemalloc.get_traced_memory()[1])
+        tracemalloc.reset_peak()
+    phase_started = (time.perf_counter(), time.process_time())
+
+def stop_phases():
+    """Stop recording and return {phase: {'wall_seconds', 'cpu_seconds'}}, plus
+    'peak_memory_bytes' when recording memory"""
+    global current_phases, started_tracing
+    phases, current_phases = current_phases, None
+    if started_tracing:
+        tracemalloc.stop()
+        started_tracing = False
+    return phases
+
+def enable_phase_report(report_path, memory=True):
+    """Record the phases of every study processed from now on as JSON lines in report_path.
+
+    Memory tracking uses tracemalloc, which slows processing down noticeably;
+    pass memory=False to record times only.
+    """
+    global report_settings
+    report_settings = {'report_path': report_path, 'memory': memory} if report_path else None
+
+@contextmanager
+def study_phases(study, pipeline):
+    """Record one study's phases into the run report, if enable_phase_report was called.
+
+    Yields a dict that callers can add fields to, e.g. event counters, or None
+    when no report is enabled.
+    """
+    if report_settings is None:
+        yield None
+        return
+
+    record = {'study': study, 'pipeline': pipeline, 'started': datetime.now().isoformat(timespec='seconds')}
+    start_phases(report_settings['memory'])
+    try:
+        yield record
+    except Exception as e:
+        record['error'] = str(e)
+        raise
+    finally:
+        # Time between the last phase and the end of the study, e.g. error handling
+        end_phase('other')
+        phases = stop_phases()
+        record['wall_seconds'] = sum(phase['wall_seconds'] for phase in phases.values())
+        record['cpu_seconds'] = sum(phase['cpu_seconds'] for phase in phases.values())
+        if report_settings['memory']:
+            record['peak_memory_bytes'] = max(phase['peak_memory_bytes'] for phase in phases.values())
+        record['phases'] = phases
+        write_report_record(report_settings['report_path'], record)
+
+def write_report_record(report_path, record):
+    # Imported here as utils.batch hands the report settings to pool workers
+    from utils.batch import append_line
+    append_line(report_path, json.dumps(record, default=str) + "\n")
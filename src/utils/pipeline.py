@@ -0,0 +1,74 @@
+import os
+
+from utils.batch import map_in_pool
+from utils.manifest import fingerprint_inputs, forget_output, is_up_to_date, load_manifest, record_output, save_manifest
+from utils.phases import end_phase, study_phases
+
+# A step is a dict of module-level functions, so steps can be sent to pool workers:
+#   'name':   step name, also the phase name in the phase report
+#   'inputs': inputs(subject_id) -> list of input paths, or None if the step does not apply to the subject
+#   'output': output(subject_id) -> path of the file the step writes
+#   'run':    run(subject_id, input_paths, output_path, **params)
+#   'params': optional keyword arguments for run; outputs are rebuilt when they change
+
+def modified_time(path):
+    return os.stat(path).st_mtime_ns if os.path.exists(path) else None
+
+def build_subject(subject_id, steps, outputs, force=False):
+    """Run the steps for one subject in order, skipping those whose output is up to date.
+
+    outputs is the manifest as loaded before the run; it is only read here. Returns
+    (output_path, fingerprint) for every output rebuilt, with None for outputs that
+    could not be built, and the number of outputs that were up to date.
+    """
+    updates = []
+    up_to_date = 0
+    with study_phases(subject_id, 'final_output'):
+        for step in steps:
+            # Inputs are listed when the step is reached, so they include files earlier steps just wrote
+            input_paths = step['inputs'](subject_id)
+            if input_paths is None:
+                continue
+            output_path = step['output'](subject_id)
+            fingerprint = fingerprint_inputs(outputs, output_path, input_paths, step.get('params', {}))
+            if not force and is_up_to_date(outputs, output_path, fingerprint):
+                up_to_date += 1
+                end_phase(step['name'])
+                continue
+            previous_mtime = modified_time(output_path)
+            try:
+                step['run'](subject_id, input_paths, output_path, **step.get('params', {}))
+            except Exception as e:
+                print(f"Error in {step['name']} for {subject_id}: {str(e)}")
+                updates.append((output_path, None))
+                break
+            # Steps that skip a subject (e.g. without a start time) leave any old output unrecorded
+            written = modified_time(output_path) not in (None, previous_mtime)
+            updates.append((output_path, fingerprint if written else None))
+            end_phase(step['name'])
+    return updates, up_to_date
+
+def run_pipeline(steps, subject_ids, manifest_dir, jobs=1, incremental=True):
+    """Bring every subject's step outputs up to date, make-style.
+
+    Outputs are recorded in the manifest next to manifest_dir with the hashes of
+    the inputs they were built from, so only outputs whose inputs or parameters
+    changed are rebuilt. Subjects are independent and run in parallel with jobs > 1.
+    """
+    outputs = load_manifest(manifest_dir)
+    results = map_in_pool(build_subject, list(subject_ids), jobs, steps=steps, outputs=outputs, force=not incremental)
+
+    rebuilt = 0
+    up_to_date = 0
+    for updates, subject_up_to_date in results:
+        up_to_date += subject_up_to_date
+        for output_path, fingerprint in updates:
+            if fingerprint is None:
+                forget_output(outputs, output_path)
+            else:
+                record_output(outputs, output_path, fingerprint)
+                rebuilt += 1
+    save_manifest(manifest_dir, outputs)
+
+    print(f"Rebuilt {rebuilt} files, {up_to_date} up to date")
+    return rebuilt, up_to_date
@@ -0,0 +1,69 @@
+import logging
+import logging.handlers
+from collections import Counter
+
+LOGGER_NAME = 'reconciliation'
+# Per-event diagnostics go to a child logger that stays silent unless requested
+EVENT_LOGGER_NAME = 'reconciliation.events'
+# Number of event records buffered before they are written out
+EVENT_BUFFER_SIZE = 10000
+
+# Counters kept per study and summed per batch, with their labels in progress lines
+COUNTER_LABELS = [
+    ('events_parsed', 'events parsed'),
+    ('events_reconciled', 'reconciled'),
+    ('events_flagged', 'flagged for review'),
+    ('boundary_misses', 'exact-boundary misses'),
+]
+
+# Settings of the last configure_logging call, handed on to pool workers
+logging_settings = None
+
+def get_logger(name):
+    return logging.getLogger(f"{LOGGER_NAME}.{name}")
+
+def get_event_logger():
+    return logging.getLogger(EVENT_LOGGER_NAME)
+
+def configure_logging(level=logging.INFO, event_details=False):
+    """Write reconciliation logs to stderr at the given level.
+
+    With event_details, per-event diagnostics are logged as well. They are
+    buffered in memory and written in blocks, once per study or when the
+    buffer fills, rather than line by line.
+    """
+    global logging_settings
+    logging_settings = {'level': level, 'event_details': event_details}
+
+    logger = logging.getLogger(LOGGER_NAME)
+    event_logger = get_event_logger()
+    for existing in [logger, event_logger]:
+        for handler in list(existing.handlers):
+            existing.removeHandler(handler)
+            handler.close()
+
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(name)s: %(message)s'))
+    logger.addHandler(handler)
+    logger.setLevel(level)
+    logger.propagate = False
+
+    event_logger.propagate = False
+    if event_details:
+        event_logger.setLevel(logging.DEBUG)
+        event_logger.addHandler(logging.handlers.MemoryHandler(EVENT_BUFFER_SIZE, flushLevel=logging.ERROR, target=handler))
+    else:
+        event_logger.setLevel(logging.CRITICAL)
+
+def flush_event_details():
+    for handler in get_event_logger().handlers:
+        handler.flush()
+
+def format_counters(counters):
+    return ", ".join(f"{counters[key]} {label}" for key, label in COUNTER_LABELS)
+
+def sum_counters(counter_list):
+    total = Counter()
+    for counters in counter_list:
+        total.update(counters)
+    return total
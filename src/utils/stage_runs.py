@@ -0,0 +1,81 @@
+import csv
+import os
+import numpy as np
+
+# Epochs the scorers did not agree on; these are never collapsed so each can be reviewed
+REVIEW_DESCRIPTION = "Stage: -"
+
+def collapse_stage_runs(annotations):
+    """Merge consecutive epochs with the same stage into one [onset, duration, description]
+    row with the summed duration. Review epochs stay one row each."""
+    runs = []
+    for onset, duration, description in annotations:
+        if (runs and description != REVIEW_DESCRIPTION and runs[-1][2] == description
+                and runs[-1][0] + runs[-1][1] == onset):
+            runs[-1][1] += duration
+        else:
+            runs.append([onset, duration, description])
+    return runs
+
+def expand_stage_runs(runs, epoch_duration=30):
+    """Split collapsed rows back into one row per epoch, as staging writes them by default"""
+    epochs = []
+    for onset, duration, description in runs:
+        for i in range(max(1, round(duration / epoch_duration))):
+            epochs.append([onset + i * epoch_duration, epoch_duration, description])
+    return epochs
+
+def expand_stage_rows(df, epoch_duration=30):
+    """expand_stage_runs for a DataFrame of stage rows: one row per epoch, so that rows can be
+    counted as epochs and paired epoch by epoch. Onsets may be seconds or datetimes.
+
+    Tables without a Duration column are taken to hold one row per epoch already. Raises
+    ValueError for rows without a numeric Duration, whose number of epochs is unknown.
+    """
+    # pandas is imported here so staging, which collapses runs with this module, starts quickly
+    import pandas as pd
+
+    if 'Duration' not in df.columns:
+        return df
+    durations = pd.to_numeric(df['Duration'], errors='coerce')
+    if durations.isna().any():
+        raise ValueError("Stage rows without a numeric Duration cannot be counted as epochs")
+
+    counts = np.maximum(1, np.round(durations.to_numpy() / epoch_duration)).astype(int)
+    expanded = df.iloc[np.repeat(np.arange(len(df)), counts)].reset_index(drop=True)
+    # Position of each epoch within its run
+    offsets = (np.arange(len(expanded)) - np.repeat(np.cumsum(counts) - counts, counts)) * epoch_duration
+    if pd.api.types.is_datetime64_any_dtype(expanded['Onset']):
+        expanded['Onset'] = expanded['Onset'] + pd.to_timedelta(offsets, unit='s')
+    else:
+        expanded['Onset'] = expanded['Onset'] + offsets
+    expanded['Duration'] = epoch_duration
+    return expanded
+
+def parse_number(value):
+    number = float(value)
+    return int(number) if number.is_integer() else number
+
+def expand_stage_file(input_file, output_file, epoch_duration=30):
+    """Rewrite a collapsed staging annotations file with one row per epoch"""
+    with open(input_file, newline='', encoding='utf-8') as f:
+        reader = csv.reader(f, delimiter='\t')
+        header = next(reader)
+        runs = [[parse_number(onset), parse_number(duration), description] for onset, duration, description in reader]
+
+    with open(output_file, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.writer(f, delimiter='\t')
+        writer.writerow(header)
+        writer.writerows(expand_stage_runs(runs, epoch_duration))
+
+if __name__ == "__main__":
+    # Directory containing the staging annotation files
+    input_dir = "output/staging_annotation"
+
+    # Expand all collapsed annotation files in the directory
+    for filename in os.listdir(input_dir):
+        if filename.endswith("_stage_annotations.csv"):
+            input_file = os.path.join(input_dir, filename)
+            output_file = os.path.join(input_dir, f"{filename[:-4]}_expanded.csv")
+            expand_stage_file(input_file, output_file)
+            print(f"Created expanded annotations file: {output_file}")
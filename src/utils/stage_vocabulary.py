@@ -0,0 +1,65 @@
+import numpy as np
+import pandas as pd
+
+# Standard stage names; a stage's position is its code in normalized stage columns
+STAGES = ['Wake', 'N1', 'N2', 'N3', 'REM', 'Artifact']
+
+# Every known spelling of a stage in final, merged and AI scored files
+SPELLINGS = {
+    'W': 'Wake',
+    'wake': 'Wake',
+    'Wake': 'Wake',
+    'WAKE': 'Wake',
+    'Wach': 'Wake',
+    'n1': 'N1',
+    'N1': 'N1',
+    'stage 1': 'N1',
+    'Stage 1': 'N1',
+    'Stadium 1': 'N1',
+    'n2': 'N2',
+    'N2': 'N2',
+    'stage 2': 'N2',
+    'Stage 2': 'N2',
+    'Stadium 2': 'N2',
+    'n3': 'N3',
+    'N3': 'N3',
+    'stage 3': 'N3',
+    'Stage 3': 'N3',
+    'Stadium 3': 'N3',
+    'rem': 'REM',
+    'Rem': 'REM',
+    'REM': 'REM',
+    'artifact': 'Artifact',
+    'Artifact': 'Artifact',
+    'artefakt': 'Artifact',
+    'Artefakt': 'Artifact',
+    'A': 'Artifact'
+}
+
+def standard_stage_name(stage):
+    """Standard name of one stage spelling. Unknown labels (e.g. '-' for epochs left
+    for review) are returned stripped, missing stages unchanged."""
+    if pd.isna(stage):
+        return stage
+    stage_str = str(stage).strip()
+    return SPELLINGS.get(stage_str, stage_str)
+
+def normalize_stages(stages):
+    """Standard names of an array of stage spellings, as a pandas Categorical.
+
+    Known stages have the fixed codes of STAGES, unknown labels follow as extra
+    categories. Each distinct spelling is looked up once and the rows are coded
+    with numpy, so the codes (int8 for fewer than 128 labels) are cheap to compare.
+    """
+    codes, spellings = pd.factorize(np.asarray(stages, dtype=object))
+    names = [standard_stage_name(spelling) for spelling in spellings]
+    categories = STAGES + [name for name in dict.fromkeys(names) if name not in STAGES]
+    category_codes = {name: code for code, name in enumerate(categories)}
+    # A trailing -1 keeps missing stages (code -1) missing
+    lookup = np.array([category_codes[name] for name in names] + [-1], dtype=np.int64)
+    return pd.Categorical.from_codes(lookup[codes], categories=categories)
+
+def count_stages(stages):
+    """Epochs per stage of a stage column, leaving out stages that do not occur"""
+    counts = stages.value_counts()
+    return counts[counts > 0]
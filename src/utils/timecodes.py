@@ -0,0 +1,51 @@
+from datetime import datetime, time, timedelta
+
+MS_PER_SECOND = 1000
+MS_PER_DAY = 24 * 60 * 60 * MS_PER_SECOND
+
+def clock_to_ms(clock):
+    """Decode a 'HH:MM:SS,mmm' or 'HH:MM:SS' clock time into milliseconds since midnight.
+
+    Clock times in exactly these forms are decoded directly; anything else is left to
+    strptime ('%H:%M:%S,%f' or '%H:%M:%S'), which raises ValueError for invalid times.
+    """
+    digits = clock[0:2] + clock[3:5] + clock[6:8] + clock[9:]
+    if (len(clock) in (8, 12) and clock[2] == ':' and clock[5] == ':' and clock[8:9] in ('', ',')
+            and digits.isascii() and digits.isdigit()):
+        hours, minutes, seconds = int(clock[0:2]), int(clock[3:5]), int(clock[6:8])
+        if hours <= 23 and minutes <= 59 and seconds <= 59:
+            ms = ((hours * 60 + minutes) * 60 + seconds) * MS_PER_SECOND
+            return ms + int(clock[9:12]) if len(clock) == 12 else ms
+    parsed = datetime.strptime(clock, '%H:%M:%S,%f' if ',' in clock else '%H:%M:%S')
+    return datetime_to_clock_ms(parsed)
+
+def datetime_to_clock_ms(dt):
+    """Milliseconds since midnight of a datetime"""
+    return ((dt.hour * 60 + dt.minute) * 60 + dt.second) * MS_PER_SECOND + dt.microsecond // 1000
+
+def event_offsets(start_clock_ms, end_clock_ms, origin_clock_ms):
+    """Convert an event's clock times into milliseconds since the recording start.
+
+    Clock times before the recording start belong to the next day, and an end
+    before its start means the event crosses midnight.
+    """
+    start = start_clock_ms
+    end = end_clock_ms
+    if start < origin_clock_ms:
+        start += MS_PER_DAY
+    if end < origin_clock_ms or end < start:
+        end += MS_PER_DAY
+    return start - origin_clock_ms, end - origin_clock_ms
+
+def offset_to_datetime(origin, ms):
+    return origin + timedelta(milliseconds=ms)
+
+def datetime_to_offset(origin, dt):
+    return (dt - origin) // timedelta(milliseconds=1)
+
+def clock_on_or_after(clock, reference):
+    """Place a clock time on the date of reference, rolling over to the next day if it falls before reference"""
+    full_datetime = datetime.combine(reference.date(), time.min) + timedelta(milliseconds=clock_to_ms(clock))
+    if full_datetime < reference:
+        full_datetime += timedelta(days=1)
+    return full_datetime
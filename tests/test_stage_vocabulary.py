@@ -0,0 +1,19 @@
+import os
+import sys
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.append(os.path.join(ROOT, 'src'))
+sys.path.append(os.path.join(ROOT, 'benchmarks'))
+
+from synthetic_data import STAGES as SYNTHETIC_STAGES
+from utils.stage_vocabulary import STAGES, normalize_stages, standard_stage_name
+
+def test_synthetic_stages_are_known_spellings():
+    # The benchmark data would otherwise show up as disagreements between spellings of one stage
+    for stage in SYNTHETIC_STAGES:
+        assert standard_stage_name(stage) in STAGES
+
+def test_normalize_stages_codes_synthetic_stages_as_standard_stages():
+    stages = normalize_stages(SYNTHETIC_STAGES)
+    assert list(stages.categories) == STAGES
+    assert list(stages) == ['Wake', 'N1', 'N2', 'N3', 'REM']